@@ -0,0 +1,55 @@
+import streamlit as st
+
+import db
+
+# --- Executive Dashboard Analytics ---
+# Everything the Executive Dashboard shows, computed on one connection and
+# cached until the data version (see db.get_data_version) or the day changes:
+# problem-item aging counts up to today.
+
+@st.cache_data(max_entries=10, show_spinner=False)
+def get_executive_snapshot(data_version, today, problem_days=10, top_parts_limit=5):
+    """
+    Returns a dict with:
+    - metrics: active_orders, car_down, received_count
+    - status_counts: item_status, count
+    - advisor_stats: service_advisor, item_status, count
+    - problem_items: see db.get_problem_items
+    - top_parts: see db.get_top_ordered_parts
+    """
+    conn = db.get_connection()
+    try:
+        # The maintained counters (one row per group) feed the metrics and both breakdowns
+        groups = db.get_parts_counters(conn=conn)
+
+        problem_items = db.get_problem_items(days_threshold=problem_days, conn=conn)
+        top_parts = db.get_top_ordered_parts(top_parts_limit, conn=conn)
+    finally:
+        conn.close()
+
+    snapshot = summarize_groups(groups)
+    snapshot['problem_items'] = problem_items
+    snapshot['top_parts'] = top_parts
+    return snapshot
+
+def summarize_groups(groups):
+    """
+    Derives the dashboard metrics and breakdowns from per
+    (item_status, service_advisor, is_cardown) counts.
+    """
+    metrics = {
+        'active_orders': int(groups['count'].sum()),
+        'car_down': int(groups.loc[groups['is_cardown'] == 1, 'count'].sum()),
+        'received_count': int(groups.loc[groups['item_status'] == 'Received', 'count'].sum()),
+    }
+
+    status_counts = groups.groupby('item_status', dropna=False, as_index=False)['count'].sum()
+
+    assigned = groups[groups['service_advisor'].notna() & (groups['service_advisor'] != 'Unknown')]
+    advisor_stats = assigned.groupby(['service_advisor', 'item_status'], as_index=False)['count'].sum()
+
+    return {
+        'metrics': metrics,
+        'status_counts': status_counts,
+        'advisor_stats': advisor_stats,
+    }
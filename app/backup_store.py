@@ -0,0 +1,434 @@
+"""
+Incremental, deduplicated backup storage.
+
+A restore point is a small JSON manifest listing the SHA-256 hashes of the
+page-aligned chunks that make up the database image. Chunks are stored once,
+content-addressed under backups/chunks/, and shared by every restore point that
+contains them, so disk use grows with the pages that changed, not with DB size.
+Chunks are gzip-compressed as they are streamed to disk; raw chunks left by older
+versions are compressed once they turn "cold" (unused by the newest restore point).
+
+Integrity: the manifest records the SHA-256 of every chunk, and the registry stores
+the SHA-256 of the manifest file itself. Taking a restore point only reads the database
+once (copy), then quick_checks and hashes the snapshot; the nightly verify rebuilds the
+newest restore point and runs PRAGMA integrity_check on it (check_image), and a restore
+checks the image it rebuilds.
+
+The database registry (database_backups table) lives in db.py; this module only
+handles files.
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import config
+
+MANIFEST_FORMAT = "chunked-v1"
+STREAM_BLOCK_SIZE = 64 * 1024
+
+
+def backup_dir():
+    path = config.DATA_DIR / "backups"
+    path.mkdir(exist_ok=True)
+    return path
+
+def chunks_dir():
+    path = backup_dir() / "chunks"
+    path.mkdir(exist_ok=True)
+    return path
+
+def _chunk_path(digest):
+    return chunks_dir() / digest[:2] / digest
+
+def _existing_chunk(digest):
+    """Returns the stored path of a chunk (raw or .gz), or None."""
+    raw = _chunk_path(digest)
+    if raw.exists():
+        return raw
+    packed = raw.with_name(digest + '.gz')
+    if packed.exists():
+        return packed
+    return None
+
+def _store_chunk(digest, data):
+    """Gzips one chunk into the store (temp file + rename). Returns the bytes written."""
+    path = _chunk_path(digest).with_name(digest + '.gz')
+    path.parent.mkdir(exist_ok=True)
+    tmp = path.with_name(digest + '.gz.partial')
+    with gzip.open(tmp, 'wb', compresslevel=config.BACKUP_GZIP_LEVEL) as out:
+        for i in range(0, len(data), STREAM_BLOCK_SIZE):
+            out.write(data[i:i + STREAM_BLOCK_SIZE])
+    os.replace(tmp, path)
+    return path.stat().st_size
+
+def _touch_chunk(digest):
+    """
+    Refreshes a stored chunk's mtime, so collect_garbage's grace period covers it
+    while a new restore point that reuses it is still being written.
+    Returns False if the chunk is gone.
+    """
+    for _ in range(2): # A raw chunk may be renamed to .gz meanwhile
+        path = _existing_chunk(digest)
+        if path is None:
+            return False
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            continue
+    return False
+
+def _source_state_path():
+    return backup_dir() / "source_state.txt"
+
+def load_source_signature():
+    """The signature saved by save_source_signature, or None."""
+    try:
+        return json.loads(_source_state_path().read_text())
+    except (OSError, ValueError):
+        return None
+
+def save_source_signature(signature):
+    """
+    Saves (or with None, forgets) the source signature of the latest restore point:
+    a value that only changes when the data does (db.py passes its change counter).
+    """
+    if signature is None:
+        _source_state_path().unlink(missing_ok=True)
+    else:
+        _source_state_path().write_text(json.dumps(signature))
+
+def is_manifest(path):
+    return Path(path).suffix == '.json'
+
+def resolve_backup_path(file_path):
+    """
+    Resolves a registry file path and refuses anything outside the backups folder,
+    so a tampered database_backups row cannot point restore/delete at other files.
+    """
+    path = Path(file_path).resolve()
+    root = backup_dir().resolve()
+    if not path.is_relative_to(root) or path.is_relative_to(chunks_dir().resolve()):
+        raise ValueError(f"Backup path outside the backups folder: {file_path}")
+    return path
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(STREAM_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _iter_chunk(digest):
+    """Streams a stored chunk's original bytes (decompressing .gz) in blocks."""
+    path = _existing_chunk(digest)
+    if path is None:
+        raise FileNotFoundError(f"Backup chunk {digest} is missing")
+    opener = gzip.open if path.suffix == '.gz' else open
+    with opener(path, 'rb') as f:
+        yield from iter(lambda: f.read(STREAM_BLOCK_SIZE), b'')
+
+def integrity_check(db_path, quick=False):
+    """
+    Runs PRAGMA integrity_check (or with quick, the faster quick_check, which skips
+    the index contents) on a database file (read-only). Returns 'ok' or the first problem.
+    """
+    pragma = "quick_check" if quick else "integrity_check"
+    conn = sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        return conn.execute(f"PRAGMA {pragma}").fetchone()[0]
+    finally:
+        conn.close()
+
+
+# --- Snapshots ---
+def online_backup(src_path, dest_path):
+    """
+    Copies a live database with the SQLite backup API in a single step, so the
+    copy is consistent and a write by another connection can't restart it.
+    In WAL mode writers aren't blocked while it runs; WAL content is included.
+    Writes to a temp file, then renames into place.
+    """
+    dest_path = Path(dest_path)
+    tmp_path = dest_path.with_name(dest_path.name + '.partial')
+    src = sqlite3.connect(src_path, timeout=20.0)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        src.backup(dst, pages=-1)
+        dst.execute("PRAGMA journal_mode=DELETE") # Self-contained file (no -wal/-shm)
+    finally:
+        dst.close()
+        src.close()
+    os.replace(tmp_path, dest_path)
+
+
+# --- Write ---
+def create_restore_point(src_path, name):
+    """
+    Snapshots src_path and stores it as a manifest + shared chunks. The snapshot gets a
+    PRAGMA quick_check first (raises ValueError if it fails); the full integrity_check
+    runs in the nightly verify (see check_image) and before a restore.
+    Returns (manifest_path, stats) where stats has the chunk counts and bytes written.
+    Chunks already in the store are reused (and touched, see _touch_chunk) rather than written.
+    """
+    snapshot = backup_dir() / f"{name}.snapshot"
+    online_backup(src_path, snapshot)
+    try:
+        check = integrity_check(snapshot, quick=True)
+        if check != 'ok':
+            raise ValueError(f"Snapshot failed integrity check: {check}")
+
+        conn = sqlite3.connect(snapshot)
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        conn.close()
+
+        chunk_size = page_size * config.BACKUP_CHUNK_PAGES
+        digests = []
+        stats = {'chunks': 0, 'new_chunks': 0, 'bytes_written': 0}
+        with open(snapshot, 'rb') as f:
+            for data in iter(lambda: f.read(chunk_size), b''):
+                digest = hashlib.sha256(data).hexdigest()
+                digests.append(digest)
+                stats['chunks'] += 1
+                if not _touch_chunk(digest):
+                    stats['new_chunks'] += 1
+                    stats['bytes_written'] += _store_chunk(digest, data)
+
+            # The manifest is not registered yet, so a concurrent prune/delete does not
+            # count it as a reference: put back any reused chunk it removed in the meantime
+            for i, digest in enumerate(digests):
+                if _existing_chunk(digest) is None:
+                    f.seek(i * chunk_size)
+                    stats['new_chunks'] += 1
+                    stats['bytes_written'] += _store_chunk(digest, f.read(chunk_size))
+
+        manifest = {
+            'format': MANIFEST_FORMAT,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'page_size': page_size,
+            'chunk_size': chunk_size,
+            'size': snapshot.stat().st_size,
+            'chunks': digests,
+        }
+    finally:
+        snapshot.unlink(missing_ok=True)
+
+    manifest_path = backup_dir() / f"{name}.json"
+    tmp = manifest_path.with_name(manifest_path.name + '.partial')
+    tmp.write_text(json.dumps(manifest))
+    os.replace(tmp, manifest_path)
+    return manifest_path, stats
+
+def read_manifest(manifest_path):
+    manifest = json.loads(Path(manifest_path).read_text())
+    if manifest.get('format') != MANIFEST_FORMAT:
+        raise ValueError(f"Unknown backup format: {manifest.get('format')}")
+    return manifest
+
+
+# --- Restore / Verify ---
+def _stream_image(manifest, out=None):
+    """
+    Streams a restore point's image chunk by chunk (into `out` if given), checking every
+    chunk hash and the whole-image hash (older manifests record one). Nothing larger than
+    one block is held in memory.
+    """
+    image_hash = hashlib.sha256()
+    size = 0
+    for digest in manifest['chunks']:
+        chunk_hash = hashlib.sha256()
+        for block in _iter_chunk(digest):
+            chunk_hash.update(block)
+            image_hash.update(block)
+            size += len(block)
+            if out is not None:
+                out.write(block)
+        if chunk_hash.hexdigest() != digest:
+            raise ValueError(f"Backup chunk {digest} is corrupt")
+    if size != manifest['size'] or ('sha256' in manifest and image_hash.hexdigest() != manifest['sha256']):
+        raise ValueError("Backup image checksum mismatch")
+
+def materialize(manifest_path, dest_path):
+    """
+    Rebuilds the database image of a restore point into dest_path, streaming and
+    verifying it (see _stream_image).
+    """
+    manifest = read_manifest(manifest_path)
+    with open(dest_path, 'wb') as out:
+        _stream_image(manifest, out)
+    return dest_path
+
+def check_chunk(digest):
+    """
+    Streams one stored chunk and checks its hash.
+    Returns (size, None) if it is sound, else (None, a description of the problem).
+    """
+    try:
+        chunk_hash = hashlib.sha256()
+        size = 0
+        for block in _iter_chunk(digest):
+            chunk_hash.update(block)
+            size += len(block)
+        if chunk_hash.hexdigest() != digest:
+            return None, f"Backup chunk {digest} is corrupt"
+        return size, None
+    except Exception as e:
+        return None, str(e)
+
+def _open_restore_point(file_path, expected_checksum):
+    """
+    Checks a registry entry's file (location, presence, file checksum).
+    Returns (manifest or legacy path, None), or (None, a description of the problem).
+    """
+    try:
+        path = resolve_backup_path(file_path)
+        if not path.exists():
+            return None, "Backup file missing from disk."
+        if expected_checksum and file_sha256(path) != expected_checksum:
+            return None, "Backup file checksum mismatch."
+        return (read_manifest(path) if is_manifest(path) else path), None
+    except Exception as e:
+        return None, str(e)
+
+def _check_legacy_copy(path):
+    try:
+        check = integrity_check(path)
+        return None if check == 'ok' else f"Integrity check failed: {check}"
+    except Exception as e:
+        return str(e)
+
+def verify_all(restore_points, max_workers=None):
+    """
+    Verifies restore points without restoring them. restore_points is a list of
+    (file_path, expected_checksum); returns one result per entry: None if it is
+    sound, else a description of the problem.
+    Restore points share most of their chunks, so every distinct chunk is read and
+    hashed once (in parallel), and each manifest is then checked against those
+    results and its recorded size. Legacy .db copies get PRAGMA integrity_check.
+    """
+    opened = [_open_restore_point(file_path, checksum) for file_path, checksum in restore_points]
+    digests = {digest for target, _ in opened if isinstance(target, dict) for digest in target['chunks']}
+    legacy = [target for target, _ in opened if isinstance(target, Path)]
+
+    workers = max_workers or config.BACKUP_VERIFY_WORKERS
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backup-verify') as pool:
+        chunk_results = dict(zip(digests, pool.map(check_chunk, digests)))
+        legacy_results = dict(zip(legacy, pool.map(_check_legacy_copy, legacy)))
+
+    results = []
+    for target, error in opened:
+        if error is None and isinstance(target, Path):
+            error = legacy_results[target]
+        elif error is None:
+            chunk_errors = [chunk_results[d][1] for d in target['chunks'] if chunk_results[d][1]]
+            if chunk_errors:
+                error = chunk_errors[0]
+            elif sum(chunk_results[d][0] for d in target['chunks']) != target['size']:
+                error = "Backup image size mismatch"
+        results.append(error)
+    return results
+
+def check_image(manifest_path):
+    """
+    Rebuilds a restore point into a scratch file (see materialize) and runs PRAGMA
+    integrity_check on it. Returns None if it is sound, else a description of the problem.
+    Reads the whole image, so the nightly verify only runs it for the newest restore point.
+    """
+    scratch = backup_dir() / f"{Path(manifest_path).stem}.verify"
+    try:
+        materialize(manifest_path, scratch)
+        check = integrity_check(scratch)
+        return None if check == 'ok' else f"Integrity check failed: {check}"
+    except Exception as e:
+        return str(e)
+    finally:
+        scratch.unlink(missing_ok=True)
+
+def verify(file_path, expected_checksum=None):
+    """
+    Verifies one restore point without restoring it (see verify_all). Returns None
+    if it is sound, else a description of the problem.
+    """
+    return verify_all([(file_path, expected_checksum)])[0]
+
+
+# --- Maintenance ---
+def _all_chunk_files():
+    for path in chunks_dir().glob('*/*'):
+        if path.suffix in ('.partial',):
+            continue
+        yield path.name.removesuffix('.gz'), path
+
+def compress_cold_chunks(hot_manifest_path):
+    """
+    Gzip-compresses every raw chunk (written before chunks were compressed on write)
+    that the latest restore point (hot_manifest_path) does not use.
+    Returns the number of chunks compressed.
+    """
+    hot = set(read_manifest(hot_manifest_path)['chunks'])
+    compressed = 0
+    for digest, path in list(_all_chunk_files()):
+        if path.suffix == '.gz' or digest in hot:
+            continue
+        packed = path.with_name(digest + '.gz')
+        tmp = path.with_name(digest + '.gz.partial')
+        with open(path, 'rb') as src, gzip.open(tmp, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp, packed)
+        path.unlink()
+        compressed += 1
+    return compressed
+
+def collect_garbage(manifest_paths, grace_seconds=3600):
+    """
+    Deletes chunks not referenced by any of the given manifests.
+    Chunks written or reused (touched) in the last grace_seconds are kept: a backup may
+    be writing a manifest that references them right now.
+    Returns the number of chunk files removed.
+    """
+    referenced = set()
+    for manifest_path in manifest_paths:
+        if Path(manifest_path).exists():
+            referenced.update(read_manifest(manifest_path)['chunks'])
+    cutoff = datetime.now().timestamp() - grace_seconds
+    removed = 0
+    for digest, path in list(_all_chunk_files()):
+        if digest not in referenced and path.stat().st_mtime < cutoff:
+            path.unlink()
+            removed += 1
+    return removed
+
+
+# --- Retention ---
+def retention_keep_ids(backups, now):
+    """
+    Retention policy: given [(id, created_at datetime), ...], returns the ids to keep.
+    Keeps the newest restore point of every hour for BACKUP_KEEP_HOURLY_HOURS, of every
+    day for BACKUP_KEEP_DAILY_DAYS and of every month for BACKUP_KEEP_MONTHLY_MONTHS,
+    and always the newest one overall.
+    """
+    def months_ago(ts):
+        return (now.year - ts.year) * 12 + now.month - ts.month
+
+    tiers = [
+        ('%Y-%m-%d %H', lambda ts: now - ts < timedelta(hours=config.BACKUP_KEEP_HOURLY_HOURS)),
+        ('%Y-%m-%d', lambda ts: now - ts < timedelta(days=config.BACKUP_KEEP_DAILY_DAYS)),
+        ('%Y-%m', lambda ts: months_ago(ts) < config.BACKUP_KEEP_MONTHLY_MONTHS),
+    ]
+    # Registry timestamps have 1-second resolution: the higher id wins a tie
+    newest_first = sorted(backups, key=lambda b: (b[1], b[0]), reverse=True)
+    keep = {newest_first[0][0]} if newest_first else set()
+    for fmt, in_window in tiers:
+        seen = set()
+        for backup_id, ts in newest_first:
+            bucket = ts.strftime(fmt)
+            if in_window(ts) and bucket not in seen:
+                seen.add(bucket)
+                keep.add(backup_id)
+    return keep
@@ -22,5 +22,50 @@ else:
     DEBUG = True
 
 DB_PATH = DATA_DIR / DB_NAME
+# Scheduler bookkeeping (job_runs, scheduler_lock) lives in its own file: its frequent
+# commits would otherwise change the app database's data version (cache keys) and backups
+SCHEDULER_DB_PATH = DATA_DIR / f"{DB_PATH.stem}_scheduler.db"
 
 
+
+# Ledger search: items loaded per "Load more" page, and hard cap per search
+LEDGER_PAGE_SIZE = int(os.getenv("LEDGER_PAGE_SIZE", 50))
+LEDGER_MAX_RESULTS = int(os.getenv("LEDGER_MAX_RESULTS", 1000))
+
+# Stale stock warnings: items 'Received' for at least STALE_STOCK_DAYS are
+# warned about, and the same item is not re-warned within STALE_STOCK_REWARN_DAYS
+STALE_STOCK_DAYS = int(os.getenv("STALE_STOCK_DAYS", 7))
+STALE_STOCK_REWARN_DAYS = int(os.getenv("STALE_STOCK_REWARN_DAYS", 3))
+
+# Morning brief: max advisors rendered/sent in parallel (bounded to be gentle on SMTP)
+BRIEF_MAX_WORKERS = int(os.getenv("BRIEF_MAX_WORKERS", 4))
+
+# Scheduler (scheduler.py): loop tick, lock takeover after a dead runner's heartbeat
+# goes quiet, job_runs history kept, and the morning brief time (HH:MM, local)
+SCHEDULER_TICK_SECONDS = int(os.getenv("SCHEDULER_TICK_SECONDS", 30))
+SCHEDULER_LOCK_STALE_SECONDS = int(os.getenv("SCHEDULER_LOCK_STALE_SECONDS", 300))
+JOB_RUNS_RETENTION_DAYS = int(os.getenv("JOB_RUNS_RETENTION_DAYS", 90))
+MORNING_BRIEF_TIME = os.getenv("MORNING_BRIEF_TIME", "08:00")
+
+# Hours between scheduled backups. Each one reads the whole database (online copy +
+# chunk hashes) unless nothing changed, so keep this well above the time a snapshot takes
+BACKUP_INTERVAL_HOURS = int(os.getenv("BACKUP_INTERVAL_HOURS", 6))
+# Incremental backups: pages per content-addressed chunk (dedup granularity)
+BACKUP_CHUNK_PAGES = int(os.getenv("BACKUP_CHUNK_PAGES", 256))
+# gzip level for new backup chunks, and threads used by verify_backups()
+BACKUP_GZIP_LEVEL = int(os.getenv("BACKUP_GZIP_LEVEL", 6))
+BACKUP_VERIFY_WORKERS = int(os.getenv("BACKUP_VERIFY_WORKERS", 4))
+# Backup retention (pruned by the scheduler): newest restore point per hour / day / month
+BACKUP_KEEP_HOURLY_HOURS = int(os.getenv("BACKUP_KEEP_HOURLY_HOURS", 24))
+BACKUP_KEEP_DAILY_DAYS = int(os.getenv("BACKUP_KEEP_DAILY_DAYS", 30))
+BACKUP_KEEP_MONTHLY_MONTHS = int(os.getenv("BACKUP_KEEP_MONTHLY_MONTHS", 12))
+
+# Notifications older than this are deleted (with every user's read state) by the scheduler
+NOTIFICATION_RETENTION_DAYS = int(os.getenv("NOTIFICATION_RETENTION_DAYS", 30))
+# Notification bell: seconds between background refreshes of the bell (a fragment, not a
+# full rerun), and max age of the in-process unread cache (bounds staleness from other processes)
+NOTIFICATION_POLL_SECONDS = int(os.getenv("NOTIFICATION_POLL_SECONDS", 30))
+NOTIFICATION_CACHE_MAX_AGE_SECONDS = int(os.getenv("NOTIFICATION_CACHE_MAX_AGE_SECONDS", 120))
+
+# Exports (exporter.py): rows fetched and written per chunk (bounds export memory)
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 1000))
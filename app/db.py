@@ -1,21 +1,56 @@
 import sqlite3
 import pandas as pd
 import bcrypt
-import os
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import re
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import utils # Added import
-from pathlib import Path
 import streamlit as st
 
 import config
 
+# Cleared while a restore is rewriting the database; new connections wait for it
+_not_in_maintenance = threading.Event()
+_not_in_maintenance.set()
+
 def get_connection():
+    _not_in_maintenance.wait()
     conn = sqlite3.connect(config.DB_PATH, timeout=20.0) # 20 second timeout for lock waiting
     conn.execute('PRAGMA journal_mode=WAL;') # Enable Write-Ahead Logging for concurrency
     conn.execute('PRAGMA synchronous=NORMAL;')
     return conn
 
+# Small pool for background queries (e.g. Ledger match counts)
+_background_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='db-background')
+
+# --- Data Version (Cache Keys) ---
+# A long-lived, read-only connection whose PRAGMA data_version changes whenever
+# ANY other connection (this process or another one) commits to the database.
+_version_conn = None
+_version_lock = threading.Lock()
+
+def get_data_version():
+    """
+    Returns a token that changes whenever the database is modified.
+    Pass it to cached functions so cached results are reused until the data changes.
+    """
+    global _version_conn
+    with _version_lock:
+        if _version_conn is None:
+            _version_conn = sqlite3.connect(config.DB_PATH, timeout=20.0, check_same_thread=False)
+        version = _version_conn.execute('PRAGMA data_version').fetchone()[0]
+        return version
+
+# Rows created by an OnOrder/BackOrder upload are existing orders; anything else was created by an Invoiced file
+EXISTING_ORDER_SOURCES = ('OnOrder', 'BackOrder')
+ORIGIN_SOURCE_FROM_LOG_SQL = """
+    CASE WHEN updates_log LIKE '%Source: OnOrder%' THEN 'OnOrder'
+         WHEN updates_log LIKE '%Source: BackOrder%' THEN 'BackOrder'
+         ELSE 'Invoiced' END
+"""
+
 def init_db():
     """
     Initialize the database with the new schema for Type A/B/B1 users
@@ -64,6 +99,7 @@ def init_db():
             
             is_archived BOOLEAN DEFAULT 0, -- For Type B1 "Post" action
             source_file_type TEXT,      -- 'OnOrder', 'BackOrder', 'Invoiced'
+            origin_source TEXT,         -- Source file that created the row (never overwritten)
             last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             posted_by TEXT,             -- User who archived it
             posted_at TIMESTAMP,        -- Time of archiving
@@ -112,6 +148,18 @@ def init_db():
         # Backfill existing received dates by copying from last_updated 
         # (It's an approximation, but prevents the app from breaking or needing regex)
         c.execute("UPDATE parts SET received_date = last_updated WHERE item_status IN ('Received', 'Partially Received')")
+
+    # SCHEMA MIGRATION: Ensure 'origin_source' exists in parts
+    # (source_file_type is overwritten by every later upload; origin_source is the file that CREATED the row)
+    backfill_origin_source = False
+    try:
+        c.execute("SELECT origin_source FROM parts LIMIT 1")
+    except Exception:
+        print("Migrating schema: Adding origin_source to parts")
+        c.execute("ALTER TABLE parts ADD COLUMN origin_source TEXT")
+        # Backfill from the upload marker in the log (parts_archive is done after it is synced below)
+        c.execute(f"UPDATE parts SET origin_source = {ORIGIN_SOURCE_FROM_LOG_SQL}")
+        backfill_origin_source = True
     
     # Check for default admin
     c.execute('SELECT * FROM users WHERE username = ?', ('admin',))
@@ -133,7 +181,7 @@ def init_db():
             advisor_code TEXT,         -- Target all users with this code (optional)
             user_type TEXT,            -- Target all users of this type (optional)
             message TEXT,
-            is_read BOOLEAN DEFAULT 0,
+            is_read BOOLEAN DEFAULT 0, -- Legacy global flag; read state is per user in notification_recipients
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
@@ -164,6 +212,16 @@ def init_db():
         )
     ''')
     
+    # --- Scheduler Tables (separate file, see init_scheduler_db) ---
+    init_scheduler_db(c)
+    
+    # SCHEMA MIGRATION: Ensure 'checksum' exists in database_backups
+    try:
+        c.execute("SELECT checksum FROM database_backups LIMIT 1")
+    except Exception:
+        print("Migrating schema: Adding checksum to database_backups")
+        c.execute("ALTER TABLE database_backups ADD COLUMN checksum TEXT") # SHA-256 of the backup file
+    
     # Create 'sadmin' user (Super Admin)
     c.execute('SELECT * FROM users WHERE username = ?', ('sadmin',))
     if not c.fetchone():
@@ -265,6 +323,657 @@ def init_db():
     except Exception as e:
         print(f"Migration error (AA/EMB/B): {e}")
 
+    # --- Indexes ---
+    # Active-view filters (dashboard, problem items, stale stock, morning brief)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_parts_status_archived ON parts(item_status, is_archived)")
+    # Shipment lookups (receive, remove, shipment aggregates)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_parts_shipment ON parts(shipment_ref)")
+
+    # --- Archive Partition (Posted items) ---
+    create_parts_archive(c)
+    if backfill_origin_source:
+        c.execute(f"UPDATE parts_archive SET origin_source = {ORIGIN_SOURCE_FROM_LOG_SQL} WHERE origin_source IS NULL")
+
+    # --- Full-Text Search Index (Ledger) ---
+    create_search_index(c)
+
+    # --- Status / Advisor Counters (Dashboard) ---
+    create_parts_counters(c)
+
+    # --- Shipment Aggregates (Receive / Shipment Overview) ---
+    create_shipments(c)
+
+    # --- Per-user notification read state (Bell) ---
+    create_notification_recipients(c)
+
+    # --- Change Counter (Scheduled backups) ---
+    create_change_counter(c)
+
+    # DATA MIGRATION: Move posted rows still in the hot table into parts_archive
+    moved = _move_parts(c, 'parts', 'parts_archive', "is_archived = 1")
+    if moved:
+        print(f"Moved {moved} archived parts to parts_archive.")
+
+    conn.commit()
+    conn.close()
+
+# --- Full-Text Search ---
+# Two FTS5 indexes over the same searchable columns, kept in sync by triggers:
+# - parts_fts (trigram): substring matching for terms of 3+ characters
+# - parts_fts_prefix (unicode61): word-prefix matching for 1-2 character terms
+# Both index active AND archived parts (content = the parts_all view); rowid = part id.
+SEARCH_COLUMNS = ['item_no', 'order_no', 'customer_name', 'document_no', 'vin', 'item_description']
+SEARCH_INDEXES = {
+    'parts_fts': "tokenize='trigram'",
+    'parts_fts_prefix': "tokenize='unicode61', prefix='1 2'",
+}
+# Source table -> trigger name suffix
+SEARCH_SOURCES = {'parts': '', 'parts_archive': '_archive'}
+
+def create_search_index(c):
+    """
+    Creates the FTS5 search tables and their sync triggers if missing.
+    Builds the index from the existing rows the first time (or when an older
+    parts-only index is upgraded to cover the archive).
+    """
+    cols = ', '.join(SEARCH_COLUMNS)
+    new_vals = ', '.join(f"new.{col}" for col in SEARCH_COLUMNS)
+    old_vals = ', '.join(f"old.{col}" for col in SEARCH_COLUMNS)
+
+    for table, options in SEARCH_INDEXES.items():
+        c.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,))
+        row = c.fetchone()
+        if row and "content='parts_all'" not in row[0]:
+            print(f"Upgrading search index {table} to include archived parts...")
+            c.execute(f"DROP TABLE {table}")
+            for trigger in ('ai', 'ad', 'au'):
+                c.execute(f"DROP TRIGGER IF EXISTS {table}_{trigger}")
+            row = None
+        is_new = row is None
+
+        c.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5(
+                {cols}, content='parts_all', content_rowid='id', {options}
+            )
+        ''')
+
+        # Only changes to the indexed columns touch the index (not updates_log appends)
+        for source, suffix in SEARCH_SOURCES.items():
+            c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}{suffix}_ai AFTER INSERT ON {source} BEGIN
+                    INSERT INTO {table}(rowid, {cols}) VALUES (new.id, {new_vals});
+                END
+            ''')
+            c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}{suffix}_ad AFTER DELETE ON {source} BEGIN
+                    INSERT INTO {table}({table}, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+                END
+            ''')
+            c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}{suffix}_au AFTER UPDATE OF {cols} ON {source} BEGIN
+                    INSERT INTO {table}({table}, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+                    INSERT INTO {table}(rowid, {cols}) VALUES (new.id, {new_vals});
+                END
+            ''')
+
+        if is_new:
+            print(f"Building search index {table}...")
+            c.execute(f"INSERT INTO {table}({table}) VALUES ('rebuild')")
+
+def build_search_match(query):
+    """
+    Returns (fts_table, match_expression) for a user search term.
+    The term is quoted as a single phrase so FTS operators in user input are ignored.
+    """
+    term = (query or '').strip()
+    phrase = '"' + term.replace('"', '""') + '"'
+    if len(term) >= 3:
+        return 'parts_fts', phrase
+    return 'parts_fts_prefix', phrase + '*'
+
+# --- Status / Advisor Counters ---
+# parts_counters holds the number of ACTIVE parts (is_archived = 0) per
+# (item_status, service_advisor, is_cardown), maintained by triggers in the same
+# transaction as the write. NULL status/advisor are stored as ''.
+COUNTER_KEY_SQL = {
+    'item_status': "COALESCE({row}.item_status, '')",
+    'service_advisor': "COALESCE({row}.service_advisor, '')",
+    'is_cardown': "CASE WHEN {row}.cardown LIKE 'Yes%' THEN 1 ELSE 0 END",
+}
+
+def create_parts_counters(c):
+    """
+    Creates the parts_counters rollup table and its triggers if missing.
+    Fills it from the parts table the first time.
+    """
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='parts_counters'")
+    is_new = c.fetchone() is None
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS parts_counters (
+            item_status TEXT NOT NULL,
+            service_advisor TEXT NOT NULL,
+            is_cardown INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (item_status, service_advisor, is_cardown)
+        )
+    ''')
+
+    new_key = ', '.join(expr.format(row='NEW') for expr in COUNTER_KEY_SQL.values())
+    old_match = ' AND '.join(f"{col} = {expr.format(row='OLD')}" for col, expr in COUNTER_KEY_SQL.items())
+    increment = f'''
+        INSERT INTO parts_counters (item_status, service_advisor, is_cardown, count)
+        SELECT {new_key}, 1 WHERE NEW.is_archived = 0
+        ON CONFLICT (item_status, service_advisor, is_cardown) DO UPDATE SET count = count + 1;
+    '''
+    decrement = f'''
+        UPDATE parts_counters SET count = count - 1
+        WHERE {old_match} AND OLD.is_archived = 0;
+    '''
+
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS parts_counters_ai AFTER INSERT ON parts BEGIN {increment} END")
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS parts_counters_ad AFTER DELETE ON parts BEGIN {decrement} END")
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS parts_counters_au
+        AFTER UPDATE OF item_status, service_advisor, cardown, is_archived ON parts
+        BEGIN {decrement} {increment} END
+    ''')
+
+    if is_new:
+        print("Building parts_counters...")
+        _fill_parts_counters(c)
+
+def _counter_truth_sql():
+    """GROUP BY over active parts, keyed exactly like parts_counters."""
+    keys = ', '.join(f"{expr.format(row='parts')} AS {col}" for col, expr in COUNTER_KEY_SQL.items())
+    return f'''
+        SELECT {keys}, COUNT(*) AS count
+        FROM parts
+        WHERE is_archived = 0
+        GROUP BY 1, 2, 3
+    '''
+
+def _fill_parts_counters(c):
+    c.execute("DELETE FROM parts_counters")
+    c.execute(f"INSERT INTO parts_counters (item_status, service_advisor, is_cardown, count) {_counter_truth_sql()}")
+
+def check_parts_counters(repair=False):
+    """
+    Consistency check: compares parts_counters with a fresh GROUP BY over parts.
+    Returns a list of mismatches (dicts with the key, stored and actual count).
+    With repair=True, rebuilds the table from scratch when anything differs.
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE") # Stable snapshot: no writes between the two reads
+        c.execute(_counter_truth_sql())
+        actual = {tuple(r[:3]): r[3] for r in c.fetchall()}
+        c.execute("SELECT item_status, service_advisor, is_cardown, count FROM parts_counters WHERE count != 0")
+        stored = {tuple(r[:3]): r[3] for r in c.fetchall()}
+
+        mismatches = []
+        for key in sorted(set(actual) | set(stored)):
+            if actual.get(key, 0) != stored.get(key, 0):
+                mismatches.append({
+                    'item_status': key[0],
+                    'service_advisor': key[1],
+                    'is_cardown': key[2],
+                    'stored': stored.get(key, 0),
+                    'actual': actual.get(key, 0)
+                })
+
+        if mismatches and repair:
+            print(f"parts_counters out of sync ({len(mismatches)} groups). Rebuilding...")
+            _fill_parts_counters(c)
+        conn.commit()
+        return mismatches
+    finally:
+        conn.close()
+
+def rebuild_parts_counters():
+    """
+    Rebuilds parts_counters from scratch.
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        _fill_parts_counters(c)
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_parts_counters(conn=None):
+    """
+    Returns the active parts counters as a DataFrame:
+    item_status, service_advisor, is_cardown, count ('' keys mapped back to None).
+    Pass an open conn to reuse it (it is left open).
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = get_connection()
+    df = pd.read_sql('''
+        SELECT NULLIF(item_status, '') AS item_status,
+               NULLIF(service_advisor, '') AS service_advisor,
+               is_cardown, count
+        FROM parts_counters
+        WHERE count > 0
+    ''', conn)
+    if own_conn:
+        conn.close()
+    return df
+
+# --- Shipment Aggregates ---
+# One row per shipment_ref (Invoiced upload) with its totals, so the shipment pages read
+# a handful of rows instead of grouping parts. Rows are recomputed for the affected
+# shipments by every write path that changes a shipment's items (Invoiced/Back Order
+# upload, receive, remove, ETA updates, post by document) in the same transaction.
+# Counts cover parts and parts_archive, like the old parts_all GROUP BY.
+
+def create_shipments(c):
+    """
+    Creates the shipments aggregate table if missing. Fills it from parts the first time.
+    """
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='shipments'")
+    is_new = c.fetchone() is None
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS shipments (
+            shipment_ref TEXT PRIMARY KEY,
+            total_items INTEGER NOT NULL DEFAULT 0,
+            in_transit_count INTEGER NOT NULL DEFAULT 0,
+            received_count INTEGER NOT NULL DEFAULT 0,
+            current_eta TEXT,
+            last_update TIMESTAMP,
+            status TEXT -- 'In Transit' if ANY item is In Transit (or Reordered), else 'Received'
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_shipments_last_update ON shipments(last_update)")
+
+    if is_new:
+        print("Building shipments...")
+        _fill_shipments(c)
+
+def _shipments_truth_sql(where_sql):
+    """GROUP BY over parts + parts_archive rows matching where_sql, shaped like the shipments table."""
+    cols = "shipment_ref, item_status, eta, last_updated"
+    return f'''
+        SELECT shipment_ref,
+               COUNT(*),
+               SUM(CASE WHEN item_status IN ('In Transit', 'Reordered') THEN 1 ELSE 0 END),
+               SUM(CASE WHEN item_status = 'Received' THEN 1 ELSE 0 END),
+               MIN(eta),
+               MAX(last_updated),
+               CASE WHEN SUM(CASE WHEN item_status IN ('In Transit', 'Reordered') THEN 1 ELSE 0 END) > 0
+                    THEN 'In Transit' ELSE 'Received' END
+        FROM (
+            SELECT {cols} FROM parts WHERE {where_sql}
+            UNION ALL
+            SELECT {cols} FROM parts_archive WHERE {where_sql}
+        )
+        GROUP BY shipment_ref
+    '''
+
+def _fill_shipments(c):
+    c.execute("DELETE FROM shipments")
+    where_sql = "shipment_ref IS NOT NULL AND shipment_ref != ''"
+    c.execute(f"INSERT INTO shipments {_shipments_truth_sql(where_sql)}")
+
+def _shipment_refs_of(c, ids):
+    """Returns the distinct shipment refs currently set on the given part ids."""
+    if len(ids) == 0:
+        return set()
+    c.execute("SELECT DISTINCT shipment_ref FROM parts WHERE id IN (SELECT value FROM json_each(?))",
+              (json.dumps([int(i) for i in ids]),))
+    return {r[0] for r in c.fetchall()}
+
+def _refresh_shipments(c, refs):
+    """
+    Recomputes the shipments rows of the given refs within the caller's transaction
+    (a shipment left with no items is removed).
+    """
+    refs = sorted({r for r in refs if r})
+    if not refs:
+        return
+    refs_json = json.dumps(refs)
+    c.execute("DELETE FROM shipments WHERE shipment_ref IN (SELECT value FROM json_each(?))", (refs_json,))
+    c.execute(f"INSERT INTO shipments {_shipments_truth_sql('shipment_ref IN (SELECT value FROM json_each(?))')}",
+              (refs_json, refs_json))
+
+def rebuild_shipments():
+    """
+    Rebuilds the shipments table from scratch. Returns the number of shipments.
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        _fill_shipments(c)
+        conn.commit()
+        c.execute("SELECT COUNT(*) FROM shipments")
+        return c.fetchone()[0]
+    finally:
+        conn.close()
+
+# --- Archive Partition ---
+# Posted (archived) parts live in parts_archive, not in parts, so active-view scans,
+# searches and aggregates only touch live rows. parts_archive has the same columns in
+# the same order as parts (kept in sync by create_parts_archive), so rows move with
+# INSERT ... SELECT and the two can be combined with UNION ALL.
+# parts_all is a UNION ALL view of both, for history queries.
+# NOTE: Avoid JOINing parts_all to other tables - SQLite materializes the whole view
+# for that. Union two joins instead (see build_item_search_query).
+
+def _table_columns(c, table):
+    return [r[1] for r in c.execute(f"PRAGMA table_info({table})").fetchall()]
+
+def create_parts_archive(c):
+    """
+    Creates parts_archive (same schema as parts) if missing, adds any columns parts
+    gained since, and (re)creates the parts_all view.
+    """
+    c.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='parts'")
+    parts_sql = c.fetchone()[0]
+    archive_sql = re.sub(r'^CREATE TABLE\s+(IF NOT EXISTS\s+)?["\[`]?parts["\]`]?', 'CREATE TABLE IF NOT EXISTS parts_archive', parts_sql, count=1)
+    c.execute(archive_sql)
+
+    # Columns added to parts by later migrations (appended in the same order)
+    archive_cols = set(_table_columns(c, 'parts_archive'))
+    for _, name, col_type, _, default, _ in c.execute("PRAGMA table_info(parts)").fetchall():
+        if name not in archive_cols:
+            print(f"Migrating schema: Adding {name} to parts_archive")
+            default_sql = f" DEFAULT {default}" if default is not None else ""
+            c.execute(f"ALTER TABLE parts_archive ADD COLUMN {name} {col_type}{default_sql}")
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_parts_archive_shipment ON parts_archive(shipment_ref)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_parts_archive_document ON parts_archive(document_no)")
+
+    cols = ', '.join(_table_columns(c, 'parts'))
+    c.execute("DROP VIEW IF EXISTS parts_all")
+    c.execute(f"CREATE VIEW parts_all AS SELECT {cols} FROM parts UNION ALL SELECT {cols} FROM parts_archive")
+
+def _stage_ids(c, ids):
+    """
+    Loads ids into temp.staged_ids (replacing its contents) for set-based statements:
+    ... WHERE id IN (SELECT id FROM temp.staged_ids). Avoids huge IN (?, ?, ...) lists.
+    """
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS staged_ids (id INTEGER PRIMARY KEY)")
+    c.execute("DELETE FROM temp.staged_ids")
+    c.executemany("INSERT OR IGNORE INTO temp.staged_ids (id) VALUES (?)", [(int(i),) for i in ids])
+
+def _move_parts(c, src, dst, where_sql, params=(), overrides=None, returning=None):
+    """
+    Moves the rows of `src` matching where_sql into `dst` (parts <-> parts_archive)
+    within the caller's transaction. `overrides` maps column -> (sql_expression, params)
+    to change values on the way (e.g. is_archived, an updates_log append).
+    The rows are deleted from src before they are inserted into dst, so the search
+    index and counter triggers only ever see each id once.
+    Returns the number of rows moved, or with `returning` (a list of columns) the
+    moved rows as dicts of those columns.
+    """
+    overrides = overrides or {}
+    cols = _table_columns(c, src)
+    select_exprs, select_params = [], []
+    for col in cols:
+        if col in overrides:
+            expr, expr_params = overrides[col]
+            select_exprs.append(f"{expr} AS {col}")
+            select_params.extend(expr_params)
+        else:
+            select_exprs.append(col)
+    col_list = ', '.join(cols)
+
+    c.execute("DROP TABLE IF EXISTS temp.moving_parts")
+    c.execute(f"CREATE TEMP TABLE moving_parts AS SELECT {', '.join(select_exprs)} FROM {src} WHERE {where_sql}",
+              list(select_params) + list(params))
+    if returning:
+        c.execute(f"SELECT {', '.join(returning)} FROM temp.moving_parts")
+        rows = [dict(zip(returning, r)) for r in c.fetchall()]
+        moved = len(rows)
+    else:
+        c.execute("SELECT COUNT(*) FROM temp.moving_parts")
+        moved = c.fetchone()[0]
+    if moved:
+        c.execute(f"DELETE FROM {src} WHERE id IN (SELECT id FROM temp.moving_parts)")
+        c.execute(f"INSERT INTO {dst} ({col_list}) SELECT {col_list} FROM temp.moving_parts")
+    c.execute("DROP TABLE temp.moving_parts")
+    return rows if returning else moved
+
+# --- Change Counter ---
+# data_changes holds a single counter bumped by triggers on every write to the business
+# tables, in the same transaction. The scheduled backup records the value its restore
+# point was taken at and skips when it has not moved (see create_database_backup).
+# Derived tables (parts_counters, shipments, search index), which the scheduler rebuilds,
+# and the backup registry are left out.
+CHANGE_COUNTER_TABLES = ['users', 'parts', 'parts_archive', 'item_remarks',
+                         'notifications', 'notification_recipients']
+
+def create_change_counter(c):
+    """
+    Creates the data_changes counter table and its triggers if missing.
+    """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS data_changes (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            counter INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute("INSERT OR IGNORE INTO data_changes (id, counter) VALUES (1, 0)")
+
+    bump = "UPDATE data_changes SET counter = counter + 1 WHERE id = 1;"
+    for table in CHANGE_COUNTER_TABLES:
+        for suffix, event in (('ai', 'INSERT'), ('au', 'UPDATE'), ('ad', 'DELETE')):
+            c.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_changes_{suffix} AFTER {event} ON {table} BEGIN {bump} END")
+
+def get_change_count():
+    """Current data_changes counter, or None if the table is missing (DB not initialized yet)."""
+    conn = get_connection()
+    try:
+        row = conn.execute("SELECT counter FROM data_changes WHERE id = 1").fetchone()
+        return row[0] if row else None
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+
+# --- Job Runs (Scheduler) ---
+# job_runs and scheduler_lock live in config.SCHEDULER_DB_PATH, not in the app database:
+# the heartbeat and run records commit every tick, and every commit to the app database
+# changes its data version (the key of every cached view) and makes it look changed to
+# the backup job. The scheduler database is bookkeeping only and is not backed up.
+def get_scheduler_connection():
+    conn = sqlite3.connect(config.SCHEDULER_DB_PATH, timeout=20.0)
+    conn.execute('PRAGMA journal_mode=WAL;')
+    conn.execute('PRAGMA synchronous=NORMAL;')
+    return conn
+
+def init_scheduler_db(c):
+    """
+    Creates the scheduler tables in the scheduler database. c is a cursor on the app
+    database: job_runs / scheduler_lock tables left there by older versions (or by a
+    restored backup) are moved over (history only while the scheduler file is new)
+    and dropped.
+    """
+    sched = get_scheduler_connection()
+    try:
+        is_new = sched.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='job_runs'").fetchone() is None
+        # job_runs: one row per job execution (see scheduler.py)
+        # scheduler_lock: single row held by the one active scheduler process
+        sched.execute('''
+            CREATE TABLE IF NOT EXISTS job_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_name TEXT NOT NULL,
+                scheduled_for TIMESTAMP,   -- Slot this run covers (manual runs: start time)
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP,
+                duration_seconds REAL,
+                rows_processed INTEGER,
+                status TEXT,               -- 'running', 'success', 'failed', 'timeout', 'skipped'
+                error TEXT,
+                is_manual INTEGER NOT NULL DEFAULT 0 -- Run by hand; does not cover a scheduled slot
+            )
+        ''')
+        sched.execute("CREATE INDEX IF NOT EXISTS idx_job_runs_name_slot ON job_runs(job_name, scheduled_for)")
+        sched.execute('''
+            CREATE TABLE IF NOT EXISTS scheduler_lock (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                owner TEXT,
+                heartbeat TIMESTAMP
+            )
+        ''')
+
+        # DATA MIGRATION: job history kept in the app database by older versions
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='job_runs'")
+        if c.fetchone():
+            if is_new:
+                cols = ['job_name', 'scheduled_for', 'started_at', 'finished_at', 'duration_seconds',
+                        'rows_processed', 'status', 'error']
+                if 'is_manual' in _table_columns(c, 'job_runs'):
+                    cols.append('is_manual')
+                rows = c.execute(f"SELECT {', '.join(cols)} FROM job_runs ORDER BY id").fetchall()
+                sched.executemany(f"INSERT INTO job_runs ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})", rows)
+                print(f"Moved {len(rows)} job runs to the scheduler database.")
+            c.execute("DROP TABLE job_runs")
+        c.execute("DROP TABLE IF EXISTS scheduler_lock")
+        sched.commit()
+    finally:
+        sched.close()
+
+def _now_str():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def start_job_run(job_name, scheduled_for, is_manual=False):
+    """
+    Records the start of a job run. Returns the job_runs id.
+    """
+    conn = get_scheduler_connection()
+    c = conn.cursor()
+    c.execute('''
+        INSERT INTO job_runs (job_name, scheduled_for, started_at, status, is_manual)
+        VALUES (?, ?, ?, 'running', ?)
+    ''', (job_name, scheduled_for.strftime('%Y-%m-%d %H:%M:%S'), _now_str(), int(is_manual)))
+    run_id = c.lastrowid
+    conn.commit()
+    conn.close()
+    return run_id
+
+def finish_job_run(run_id, status, rows_processed=None, error=None):
+    """
+    Records the end of a job run (status, duration, rows processed, error).
+    """
+    conn = get_scheduler_connection()
+    conn.execute('''
+        UPDATE job_runs
+        SET finished_at = ?, status = ?, rows_processed = ?, error = ?,
+            duration_seconds = ROUND((julianday(?) - julianday(started_at)) * 86400, 3)
+        WHERE id = ?
+    ''', (_now_str(), status, rows_processed, error, _now_str(), run_id))
+    conn.commit()
+    conn.close()
+
+def record_skipped_job_run(job_name, scheduled_for, reason):
+    """
+    Records a slot that was deliberately not run (e.g. missed outside its catch-up window).
+    """
+    now = _now_str()
+    conn = get_scheduler_connection()
+    conn.execute('''
+        INSERT INTO job_runs (job_name, scheduled_for, started_at, finished_at, duration_seconds, rows_processed, status, error)
+        VALUES (?, ?, ?, ?, 0, 0, 'skipped', ?)
+    ''', (job_name, scheduled_for.strftime('%Y-%m-%d %H:%M:%S'), now, now, reason))
+    conn.commit()
+    conn.close()
+
+def get_last_job_slot(job_name):
+    """
+    Returns the latest slot (datetime) a job has run or been skipped for, or None.
+    Manual runs do not count.
+    """
+    conn = get_scheduler_connection()
+    row = conn.execute("SELECT MAX(scheduled_for) FROM job_runs WHERE job_name = ? AND is_manual = 0", (job_name,)).fetchone()
+    conn.close()
+    if not row or not row[0]:
+        return None
+    return datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S')
+
+def get_job_runs(limit=50):
+    """
+    Returns the most recent job runs as a DataFrame.
+    """
+    conn = get_scheduler_connection()
+    df = pd.read_sql("SELECT * FROM job_runs ORDER BY id DESC LIMIT ?", conn, params=(limit,))
+    conn.close()
+    return df
+
+def fail_interrupted_job_runs(older_than_seconds):
+    """
+    Marks runs left 'running' by a scheduler that died as failed.
+    Only call right after taking over the scheduler lock.
+    """
+    conn = get_scheduler_connection()
+    c = conn.cursor()
+    c.execute('''
+        UPDATE job_runs SET status = 'failed', error = 'Interrupted (scheduler stopped)'
+        WHERE status = 'running' AND started_at < datetime('now', 'localtime', ?)
+    ''', (f'-{int(older_than_seconds)} seconds',))
+    count = c.rowcount
+    conn.commit()
+    conn.close()
+    return count
+
+def prune_job_runs(days):
+    """
+    Deletes job_runs older than `days`. Returns the number of rows removed.
+    """
+    conn = get_scheduler_connection()
+    c = conn.cursor()
+    c.execute("DELETE FROM job_runs WHERE started_at < datetime('now', 'localtime', ?)", (f'-{int(days)} days',))
+    count = c.rowcount
+    conn.commit()
+    conn.close()
+    return count
+
+def checkpoint_wal():
+    """
+    Copies as much of the WAL into the main database file as it can without waiting
+    (PASSIVE: never blocks readers or writers; SQLite reuses the WAL from the start
+    once it has all been copied). Returns (busy, wal_pages, checkpointed_pages).
+    """
+    conn = get_connection()
+    try:
+        return conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+    finally:
+        conn.close()
+
+def acquire_scheduler_lock(owner, stale_seconds):
+    """
+    Takes (or refreshes) the single-runner scheduler lock.
+    The lock is granted if it is free, already ours, or its heartbeat is older than stale_seconds.
+    Returns True if `owner` holds the lock.
+    """
+    conn = get_scheduler_connection()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT owner, heartbeat FROM scheduler_lock WHERE id = 1")
+        row = c.fetchone()
+        if row and row[0] != owner:
+            age = datetime.now() - datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S')
+            if age.total_seconds() < stale_seconds:
+                conn.rollback()
+                return False
+            print(f"Taking over stale scheduler lock from {row[0]}")
+        c.execute('''
+            INSERT INTO scheduler_lock (id, owner, heartbeat) VALUES (1, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET owner = excluded.owner, heartbeat = excluded.heartbeat
+        ''', (owner, _now_str()))
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+def release_scheduler_lock(owner):
+    conn = get_scheduler_connection()
+    conn.execute("DELETE FROM scheduler_lock WHERE id = 1 AND owner = ?", (owner,))
     conn.commit()
     conn.close()
 
@@ -375,6 +1084,27 @@ def get_user_emails_by_advisor_code(advisor_code):
     conn.close()
     return rows # [(email, username), ...]
 
+def get_user_emails_by_advisor_codes(advisor_codes):
+    """
+    Batched get_user_emails_by_advisor_code: one query for many codes.
+    Returns {advisor_code: [(email, username), ...]} (codes without users are omitted).
+    """
+    codes = list(advisor_codes)
+    if not codes:
+        return {}
+    conn = get_connection()
+    c = conn.cursor()
+    placeholders = ','.join('?' * len(codes))
+    c.execute(f'''
+        SELECT service_advisor_code, email, username FROM users
+        WHERE service_advisor_code IN ({placeholders}) AND email IS NOT NULL AND email != ""
+    ''', codes)
+    recipients = {}
+    for code, email, username in c.fetchall():
+        recipients.setdefault(code, []).append((email, username))
+    conn.close()
+    return recipients
+
 # --- Data Management ---
 
 def insert_part_record(data, source_type):
@@ -468,6 +1198,7 @@ def insert_part_record(data, source_type):
             # We found matching records!
             ids_to_update = [m[0] for m in matches]
             placeholders = ','.join('?' for _ in ids_to_update)
+            shipment_refs = _shipment_refs_of(c, ids_to_update) # Shipments the items leave (refreshed below)
             
             if source_type == 'BackOrder':
                 # Action: Update Status to BackOrder, Sync Info
@@ -487,6 +1218,7 @@ def insert_part_record(data, source_type):
                         source_file_type = 'BackOrder'
                     WHERE id IN ({placeholders})
                 ''', [data.get('eta'), data.get('next_info', ''), data.get('cardown'), log_update] + ids_to_update)
+                _refresh_shipments(c, shipment_refs)
                 
                 conn.commit()
                 conn.close()
@@ -568,6 +1300,7 @@ def insert_part_record(data, source_type):
                 if ids_in_transit:
                      ph_it = ','.join('?' for _ in ids_in_transit)
                      c.execute(f'''UPDATE parts SET item_status = 'In Transit', in_transit_qty = ?, shipment_ref = ?, eta = ?, updates_log = updates_log || ?, last_updated = CURRENT_TIMESTAMP, source_file_type = 'Invoiced' WHERE id IN ({ph_it})''', [data.get('received_qty'), data.get('shipment_ref'), data.get('eta'), log_update] + ids_in_transit)
+                _refresh_shipments(c, shipment_refs | {data.get('shipment_ref')})
                     
                 conn.commit()
                 conn.close()
@@ -586,8 +1319,8 @@ def insert_part_record(data, source_type):
             INSERT INTO parts (
                 item_no, item_description, customer_no, customer_name, 
                 document_no, order_no, service_advisor, ordered_qty, 
-                item_status, eta, updates_log, source_file_type, cardown, is_archived
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+                item_status, eta, updates_log, source_file_type, origin_source, cardown, is_archived
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
         ''', (
             data.get('item_no'), 
             data.get('item_description'),
@@ -601,6 +1334,7 @@ def insert_part_record(data, source_type):
             data.get('eta'),
             log_entry,
             'OnOrder',
+            'OnOrder',
             data.get('cardown', 'No')
         ))
     except Exception as e:
@@ -619,10 +1353,11 @@ def insert_part_record(data, source_type):
     
     return [notif_data]
 
-@st.cache_data(ttl=5, show_spinner=False)
-def get_parts_view(user_type, service_advisor_code=None):
-    conn = get_connection()
-    
+def build_parts_view_query(user_type, service_advisor_code=None):
+    """
+    Builds the SQL for the active parts visible to a role (with the latest remark),
+    newest first. Returns (query, params). Shared by get_parts_view and exporter.py.
+    """
     # Base Query with Subqueries for Remarks
     base_query = '''
         SELECT p.*, 
@@ -666,6 +1401,16 @@ def get_parts_view(user_type, service_advisor_code=None):
     
     # Sort
     base_query += " ORDER BY p.last_updated DESC"
+    return base_query, params
+
+def get_parts_view(user_type, service_advisor_code=None):
+    """
+    Active parts visible to a role. Not cached here: the dashboard caches the prepared
+    frame by data version (main.get_prepared_parts_frame), which a TTL cache here would
+    let go stale right after a write.
+    """
+    conn = get_connection()
+    base_query, params = build_parts_view_query(user_type, service_advisor_code)
         
     try:
         df = pd.read_sql(base_query, conn, params=params)
@@ -676,35 +1421,32 @@ def get_parts_view(user_type, service_advisor_code=None):
     conn.close()
     return df
 
+ARCHIVED_PARTS_QUERY = '''
+    SELECT * FROM parts_archive 
+    ORDER BY last_updated DESC
+'''
+
 def get_archived_parts():
     """
-    Fetches all parts where is_archived = 1 (Posted items).
+    Fetches all archived (Posted) parts.
     """
     conn = get_connection()
-    c = conn.cursor()
-    # Also fetch the updates_log to see when it was posted?
-    query = '''
-        SELECT * FROM parts 
-        WHERE is_archived = 1 
-        ORDER BY last_updated DESC
-    '''
-    df = pd.read_sql(query, conn)
+    df = pd.read_sql(ARCHIVED_PARTS_QUERY, conn)
     conn.close()
     return df
 
 def restore_archived_part(part_id, user_name):
     """
-    Restores an archived part (Unship).
+    Restores an archived part (Unship): moves it back from parts_archive to parts.
     """
     conn = get_connection()
     c = conn.cursor()
     log_entry = f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M')}] {user_name}: Restored (Unshipped)"
     try:
-        c.execute('''
-            UPDATE parts 
-            SET is_archived = 0, updates_log = updates_log || ? 
-            WHERE id = ?
-        ''', (log_entry, part_id))
+        _move_parts(c, 'parts_archive', 'parts', "id = ?", (part_id,), {
+            'is_archived': ('0', ()),
+            'updates_log': ("updates_log || ?", (log_entry,)),
+        })
         conn.commit()
         return True
     except Exception as e:
@@ -716,21 +1458,19 @@ def restore_archived_part(part_id, user_name):
 
 def archive_part(part_id, user_name):
     """
-    Archives a part (Type B1 Post action).
+    Archives a part (Type B1 Post action): moves it from parts to parts_archive.
     """
     conn = get_connection()
     c = conn.cursor()
     now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     log_entry = f"\n[{now_str}] {user_name}: Archived (Posted)"
     try:
-        c.execute('''
-            UPDATE parts 
-            SET is_archived = 1, 
-                updates_log = updates_log || ?,
-                posted_by = ?,
-                posted_at = ?
-            WHERE id = ?
-        ''', (log_entry, user_name, now_str, part_id))
+        _move_parts(c, 'parts', 'parts_archive', "id = ?", (part_id,), {
+            'is_archived': ('1', ()),
+            'updates_log': ("updates_log || ?", (log_entry,)),
+            'posted_by': ('?', (user_name,)),
+            'posted_at': ('?', (now_str,)),
+        })
         conn.commit()
         return True
     except Exception as e:
@@ -739,6 +1479,54 @@ def archive_part(part_id, user_name):
     finally:
         conn.close()
 
+def archive_parts(part_ids, user_name, required_status=None):
+    """
+    Archives (Posts) any number of parts in one transaction.
+    With required_status, only parts currently in that status are posted.
+    Returns (posted_count, updates_by_advisor) where updates_by_advisor maps each
+    advisor code to the email payload of its posted items.
+    """
+    if len(part_ids) == 0:
+        return 0, {}
+    conn = get_connection()
+    c = conn.cursor()
+    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    log_entry = f"\n[{now_str}] {user_name}: Archived (Posted)"
+    where_sql = "id IN (SELECT id FROM temp.staged_ids)"
+    params = ()
+    if required_status:
+        where_sql += " AND item_status = ?"
+        params = (required_status,)
+    try:
+        _stage_ids(c, part_ids)
+        posted = _move_parts(c, 'parts', 'parts_archive', where_sql, params, {
+            'is_archived': ('1', ()),
+            'updates_log': ("updates_log || ?", (log_entry,)),
+            'posted_by': ('?', (user_name,)),
+            'posted_at': ('?', (now_str,)),
+        }, returning=['service_advisor', 'item_no', 'item_description', 'document_no', 'customer_no', 'customer_name'])
+        conn.commit()
+    except Exception as e:
+        print(f"Error archiving: {e}")
+        conn.rollback()
+        return 0, {}
+    finally:
+        conn.close()
+
+    updates_by_advisor = {}
+    for row in posted:
+        adv = row['service_advisor']
+        if adv and adv != 'Unknown':
+            updates_by_advisor.setdefault(adv, []).append({
+                'item_no': row['item_no'],
+                'status': 'Posted / Archived',
+                'description': row['item_description'],
+                'document_no': row['document_no'],
+                'customer_no': row['customer_no'],
+                'customer_name': row['customer_name']
+            })
+    return len(posted), updates_by_advisor
+
 def update_remarks(part_id, new_remarks, user_name):
     # Backward compatibility wrapper, or maybe decommission?
     # For now, if "remarks" column is edited directly (legacy), we add a new entry?
@@ -772,6 +1560,7 @@ def add_remark(part_id, text, follow_up, remember_on, user_name):
     
     conn.commit()
     conn.close()
+    invalidate_unread_notifications()
 
 def get_remarks_for_part(part_id):
     conn = get_connection()
@@ -789,10 +1578,12 @@ def check_daily_reminders(username):
     # Assumption: If I entered the remark, I want to be reminded.
     cursor = conn.cursor()
     cursor.execute('''
-        SELECT r.id, p.item_no, r.remark_text, r.follow_up_date, r.remember_on_date
+        SELECT r.id, COALESCE(p.item_no, a.item_no), r.remark_text, r.follow_up_date, r.remember_on_date
         FROM item_remarks r
-        JOIN parts p ON r.part_id = p.id
+        LEFT JOIN parts p ON r.part_id = p.id
+        LEFT JOIN parts_archive a ON r.part_id = a.id
         WHERE (r.remember_on_date = ? OR r.follow_up_date = ?) AND r.entered_by = ?
+          AND (p.id IS NOT NULL OR a.id IS NOT NULL)
     ''', (today, today, username))
     
     alerts = []
@@ -815,14 +1606,82 @@ def check_daily_reminders(username):
     conn.close()
     return alerts
 
+# --- Notifications ---
+# A notification (message + its target: user / advisor code / user type, or none = everyone)
+# is stored once in `notifications` and fanned out on insert to one notification_recipients
+# row per targeted user, which holds that user's own read state. The bell is an indexed
+# lookup on (user_id, is_read, created_at); "Clear All" only touches the caller's rows.
+# Both tables are pruned after NOTIFICATION_RETENTION_DAYS (scheduler: notification_prune).
+
+# Which users receive notification n (admins receive everything)
+NOTIFICATION_TARGET_SQL = '''
+    u.user_type LIKE '%admin%'
+    OR u.id = n.user_id
+    OR (n.user_id IS NULL AND COALESCE(n.advisor_code, '') = '' AND COALESCE(n.user_type, '') = '')
+    OR n.advisor_code = 'ALL'
+    OR (COALESCE(n.advisor_code, '') != '' AND n.advisor_code = u.service_advisor_code)
+    OR (COALESCE(n.user_type, '') != '' AND u.user_type LIKE '%' || n.user_type || '%')
+'''
+
+def create_notification_recipients(c):
+    """
+    Creates the per-user notification_recipients table if missing. The first time,
+    notifications that are still unread are fanned out to their current recipients.
+    """
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='notification_recipients'")
+    is_new = c.fetchone() is None
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS notification_recipients (
+            notification_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            is_read INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- Copy of the notification's, for the index
+            read_at TIMESTAMP,
+            PRIMARY KEY (notification_id, user_id)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notification_recipients_unread ON notification_recipients(user_id, is_read, created_at, notification_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notifications_created ON notifications(created_at)")
+
+    if is_new:
+        migrated = _fan_out_notifications(c, "n.is_read = 0")
+        if migrated:
+            print(f"Migrated {migrated} unread notification receipts.")
+
+def _fan_out_notifications(c, where_sql, params=()):
+    """Inserts a recipient row per targeted user for the notifications matching where_sql."""
+    c.execute(f'''
+        INSERT OR IGNORE INTO notification_recipients (notification_id, user_id, created_at)
+        SELECT n.id, u.id, n.created_at
+        FROM notifications n JOIN users u ON ({NOTIFICATION_TARGET_SQL})
+        WHERE {where_sql}
+    ''', params)
+    return c.rowcount
+
+# Unread cache: user_id -> (cached_at, {'count', 'items'}), shared by every session of this
+# process so the bell (polled by a fragment, rendered by each toolbar) usually costs no query.
+# Writers in this process invalidate it after they commit; entries also expire after
+# NOTIFICATION_CACHE_MAX_AGE_SECONDS to pick up writes from other processes (e.g. pruning).
+_unread_cache = {}
+_unread_cache_lock = threading.Lock()
+
+def invalidate_unread_notifications(user_id=None):
+    """Drops the cached unread notifications of one user, or of everyone (None)."""
+    with _unread_cache_lock:
+        if user_id is None:
+            _unread_cache.clear()
+        else:
+            _unread_cache.pop(user_id, None)
+
 # Helper for internal notification use
+# The caller commits, then calls invalidate_unread_notifications().
 def add_notification_internal(cursor, message, target_user_id=None, target_advisor_code=None, target_type=None):
     cursor.execute('''
         INSERT INTO notifications (user_id, advisor_code, user_type, message)
         VALUES (?, ?, ?, ?)
     ''', (target_user_id, target_advisor_code, target_type, message))
-
-# --- Notifications ---
+    _fan_out_notifications(cursor, "n.id = ?", (cursor.lastrowid,))
 
 def add_notification(message, target_user_id=None, target_advisor_code=None, target_type=None):
     """
@@ -830,66 +1689,107 @@ def add_notification(message, target_user_id=None, target_advisor_code=None, tar
     """
     conn = get_connection()
     c = conn.cursor()
-    c.execute('''
-        INSERT INTO notifications (user_id, advisor_code, user_type, message)
-        VALUES (?, ?, ?, ?)
-    ''', (target_user_id, target_advisor_code, target_type, message))
-    conn.commit()
-    conn.close()
+    try:
+        add_notification_internal(c, message, target_user_id, target_advisor_code, target_type)
+        conn.commit()
+    except Exception as e:
+        print(f"Error adding notification: {e}")
+    finally:
+        conn.close()
+    invalidate_unread_notifications()
 
-def get_notifications_for_user(user_id, user_type_str, advisor_code):
+def get_notifications_for_user(user_id, limit=50):
     """
-    Get generic notifications or specific ones for this user.
+    Returns the user's unread notifications (newest first): dicts with id, message, created_at.
     """
+    if user_id is None:
+        return []
     conn = get_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
-    
-    # Filter Logic
-    # 1. Admin: View All
-    if user_type_str and 'admin' in str(user_type_str):
-        c.execute("SELECT * FROM notifications WHERE is_read = 0 ORDER BY created_at DESC LIMIT 50")
-    else:
-        # 2. Others: View Global + Specific to Code/Type
-        query = '''
-            SELECT * FROM notifications 
-            WHERE is_read = 0 
-            AND (
-                -- a. Global (No target)
-                ( (advisor_code IS NULL OR advisor_code = '') AND (user_type IS NULL OR user_type = '') )
-                OR
-                -- b. Targeted to my Advisor Code (or ALL)
-                (advisor_code = ? OR advisor_code = 'ALL')
-                OR
-                -- c. Targeted to my User Type (e.g. 'B' targeting 'B')
-                -- Check if Notification's user_type is present in my user_type_str list
-                (user_type IS NOT NULL AND user_type != '' AND ? LIKE '%' || user_type || '%')
-            )
-            ORDER BY created_at DESC LIMIT 50
-        '''
-        # Ensure advisor_code is string or None
-        c.execute(query, (advisor_code, user_type_str))
-    
+    c.execute('''
+        SELECT n.id, n.message, r.created_at
+        FROM notification_recipients r
+        JOIN notifications n ON n.id = r.notification_id
+        WHERE r.user_id = ? AND r.is_read = 0
+        ORDER BY r.created_at DESC, r.notification_id DESC
+        LIMIT ?
+    ''', (user_id, limit))
     rows = c.fetchall()
     conn.close()
     return [dict(r) for r in rows]
 
-def mark_notification_read(notif_id):
+def get_unread_notifications(user_id):
+    """
+    Cached unread state for the bell: {'count': total unread, 'items': newest 50 (see
+    get_notifications_for_user)}. Served from the in-process cache while it is fresh.
+    """
+    if user_id is None:
+        return {'count': 0, 'items': []}
+    now = datetime.now().timestamp()
+    with _unread_cache_lock:
+        cached = _unread_cache.get(user_id)
+    if cached and now - cached[0] < config.NOTIFICATION_CACHE_MAX_AGE_SECONDS:
+        return cached[1]
+
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM notification_recipients WHERE user_id = ? AND is_read = 0", (user_id,))
+    count = c.fetchone()[0]
+    conn.close()
+    unread = {'count': count, 'items': get_notifications_for_user(user_id) if count else []}
+    with _unread_cache_lock:
+        _unread_cache[user_id] = (now, unread)
+    return unread
+
+def mark_notification_read(notif_id, user_id):
+    """
+    Marks one notification as read for this user only.
+    """
     conn = get_connection()
     c = conn.cursor()
-    c.execute("UPDATE notifications SET is_read = 1 WHERE id = ?", (notif_id,))
+    c.execute('''
+        UPDATE notification_recipients SET is_read = 1, read_at = CURRENT_TIMESTAMP
+        WHERE notification_id = ? AND user_id = ?
+    ''', (notif_id, user_id))
     conn.commit()
     conn.close()
+    invalidate_unread_notifications(user_id)
 
-def mark_all_notifications_read():
+def mark_all_notifications_read(user_id):
     """
-    Marks all currently unread notifications as read.
+    Marks all of this user's unread notifications as read (other users are not affected).
     """
     conn = get_connection()
     c = conn.cursor()
-    c.execute("UPDATE notifications SET is_read = 1 WHERE is_read = 0")
+    c.execute('''
+        UPDATE notification_recipients SET is_read = 1, read_at = CURRENT_TIMESTAMP
+        WHERE user_id = ? AND is_read = 0
+    ''', (user_id,))
     conn.commit()
     conn.close()
+    invalidate_unread_notifications(user_id)
+
+def prune_notifications(days=None):
+    """
+    Deletes notifications (and their recipient rows) older than `days`
+    (default NOTIFICATION_RETENTION_DAYS). Returns the number of notifications removed.
+    """
+    days = config.NOTIFICATION_RETENTION_DAYS if days is None else days
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        # Cutoff in SQL (UTC), the same clock as created_at's CURRENT_TIMESTAMP
+        cutoff = c.execute("SELECT datetime('now', ?)", (f'-{int(days)} days',)).fetchone()[0]
+        c.execute("DELETE FROM notification_recipients WHERE created_at < ?", (cutoff,))
+        c.execute("DELETE FROM notifications WHERE created_at < ?", (cutoff,))
+        removed = c.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    invalidate_unread_notifications()
+    return removed
+
 def clear_all_data():
     """
     Clears all business data (Parts, Remarks, Notifications) but KEEPS Users.
@@ -899,11 +1799,15 @@ def clear_all_data():
     c = conn.cursor()
     try:
         c.execute("DELETE FROM parts")
+        c.execute("DELETE FROM parts_archive")
+        c.execute("DELETE FROM shipments")
         c.execute("DELETE FROM item_remarks")
         c.execute("DELETE FROM notifications")
+        c.execute("DELETE FROM notification_recipients")
         # Reset sequences if desired, but not strictly necessary
         c.execute("UPDATE sqlite_sequence SET seq=0 WHERE name IN ('parts', 'item_remarks', 'notifications')")
         conn.commit()
+        invalidate_unread_notifications()
         return True
     except Exception as e:
         print(f"Error clearing data: {e}")
@@ -919,13 +1823,12 @@ def get_pending_shipments():
     """
     conn = get_connection()
     c = conn.cursor()
-    # Distinct shipment items that are In Transit
+    # Shipments with In Transit / Reordered items (read from the shipments aggregate)
     c.execute('''
-        SELECT DISTINCT shipment_ref 
-        FROM parts 
-        WHERE (item_status = 'In Transit' OR item_status = 'Reordered')
-          AND shipment_ref IS NOT NULL 
-          AND shipment_ref != ''
+        SELECT shipment_ref 
+        FROM shipments 
+        WHERE in_transit_count > 0
+        ORDER BY shipment_ref
     ''')
     rows = c.fetchall()
     conn.close()
@@ -950,37 +1853,18 @@ def get_shipment_items(shipment_ref):
 
 def get_all_shipments_summary():
     """
-    Returns summary of all shipments (Invoiced uploads).
+    Returns summary of all shipments (Invoiced uploads), read from the shipments aggregate.
+    Status is 'In Transit' if ANY item is In Transit (or Reordered), else 'Received'.
     """
     conn = get_connection()
-    # Logic: Group by shipment_ref
-    # Status is 'In Transit' if ANY item is In Transit (or Reordered).
-    # Status is 'Received' if ALL items are Received (or Archived/Posted).
     query = '''
-        SELECT 
-            shipment_ref,
-            MIN(eta) as current_eta,
-            MAX(last_updated) as last_update,
-            COUNT(*) as total_items,
-            SUM(CASE WHEN item_status IN ('In Transit', 'Reordered') THEN 1 ELSE 0 END) as in_transit_count,
-            SUM(CASE WHEN item_status = 'Received' THEN 1 ELSE 0 END) as received_count
-        FROM parts
-        WHERE shipment_ref IS NOT NULL AND shipment_ref != ''
-        GROUP BY shipment_ref
+        SELECT shipment_ref, current_eta, last_update, total_items,
+               in_transit_count, received_count, status
+        FROM shipments
         ORDER BY last_update DESC
     '''
     df = pd.read_sql(query, conn)
     conn.close()
-    
-    # Post-process to determine display status
-    def get_status(row):
-        if row['in_transit_count'] > 0:
-            return 'In Transit'
-        return 'Received'
-        
-    if not df.empty:
-        df['status'] = df.apply(get_status, axis=1)
-        
     return df
 
 def update_shipment_eta(shipment_ref, new_eta, user_name):
@@ -1014,6 +1898,7 @@ def update_shipment_eta(shipment_ref, new_eta, user_name):
             SET eta = ?, updates_log = updates_log || ?, last_updated = CURRENT_TIMESTAMP
             WHERE shipment_ref = ? AND item_status IN ('In Transit', 'Reordered')
         ''', (new_eta, log_entry, shipment_ref))
+        _refresh_shipments(c, [shipment_ref])
         conn.commit()
         return affected_items
     except Exception as e:
@@ -1026,63 +1911,52 @@ def update_shipment_eta(shipment_ref, new_eta, user_name):
 
 def receive_shipment_items(records, user_name):
     """
-    Receives items from Review stage.
-    records: list of dicts with {'id': int, 'received_qty': int}
+    Receives items from Review stage in one transaction: all target rows are read with
+    one join against the staged quantities and updated with one executemany.
+    records: list of dicts with {'id': int, 'received_qty': int}; records without a
+    valid id or a non-negative quantity are skipped (the caller should report them).
+    Returns (received_count, updates_by_advisor) where updates_by_advisor maps each
+    advisor code to the email payload of its received items.
     """
+    # Same id listed twice -> quantities add up, as the per-row loop did
+    qty_by_id = {}
+    for rec in records:
+        try:
+            p_id, qty = int(rec['id']), int(rec['received_qty'])
+        except (KeyError, TypeError, ValueError): # Empty / NaN cell from the editor
+            print(f"Skipping receipt with invalid id/quantity: {rec}")
+            continue
+        if qty < 0:
+            print(f"Skipping receipt with negative quantity: {rec}")
+            continue
+        qty_by_id[p_id] = qty_by_id.get(p_id, 0) + qty
+    if not qty_by_id:
+        return 0, {}
+
     conn = get_connection()
     c = conn.cursor()
-    count = 0
     now_str = datetime.now().strftime('%Y-%m-%d %H:%M')
-    
-    # Store IDs for notification
-    received_ids = []
-    notifs = []
-    
     try:
-        for rec in records:
-            p_id = rec['id']
-            qty = rec['received_qty']
-            
-            # Fetch current state
-            c.execute("SELECT ordered_qty, received_qty, service_advisor, item_no, item_description, document_no, customer_no, customer_name FROM parts WHERE id = ?", (p_id,))
-            row = c.fetchone()
-            
-            ordered = row[0] if row else 0
-            current_received = row[1] if row and row[1] else 0
-            advisor = row[2] if row else 'Unknown'
-            item_no = row[3] if row else 'Unknown'
-            desc = row[4] if row else ''
-            
-            doc_no = row[5] if row else ''
-            cust_no = row[6] if row else ''
-            cust_name = row[7] if row else ''
-            
-            # Accumulate
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS receiving (id INTEGER PRIMARY KEY, qty INTEGER)")
+        c.execute("DELETE FROM temp.receiving")
+        c.executemany("INSERT INTO temp.receiving (id, qty) VALUES (?, ?)", qty_by_id.items())
+        c.execute('''
+            SELECT p.id, r.qty, COALESCE(p.ordered_qty, 0), COALESCE(p.received_qty, 0), p.service_advisor,
+                   p.item_no, p.item_description, p.document_no, p.customer_no, p.customer_name, p.shipment_ref
+            FROM temp.receiving r JOIN parts p ON p.id = r.id
+        ''')
+        rows = c.fetchall()
+
+        updates = []
+        updates_by_advisor = {}
+        shipment_refs = set()
+        for p_id, qty, ordered, current_received, advisor, item_no, desc, doc_no, cust_no, cust_name, ship_ref in rows:
+            shipment_refs.add(ship_ref)
             new_total_received = current_received + qty
-            
-            # Determine Status
-            if new_total_received >= ordered:
-                new_status = 'Received'
-            else:
-                new_status = 'Partially Received'
-                
+            new_status = 'Received' if new_total_received >= ordered else 'Partially Received'
             log_entry = f"\n[{now_str}] {user_name}: Received +{qty} (Total: {new_total_received} / {ordered})"
-            
-            # Update
-            c.execute('''
-                UPDATE parts 
-                SET received_qty = ?, 
-                    item_status = ?,
-                    updates_log = updates_log || ?,
-                    received_date = CURRENT_TIMESTAMP,
-                    last_updated = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (new_total_received, new_status, log_entry, p_id))
-            
-            count += 1
-            # Add to Notification List
-            notifs.append({
-                'advisor': advisor,
+            updates.append((new_total_received, new_status, log_entry, p_id))
+            updates_by_advisor.setdefault(advisor or 'Unknown', []).append({
                 'item_no': item_no,
                 'status': new_status,
                 'description': desc,
@@ -1090,14 +1964,26 @@ def receive_shipment_items(records, user_name):
                 'customer_no': cust_no,
                 'customer_name': cust_name
             })
-        
+
+        c.executemany('''
+            UPDATE parts 
+            SET received_qty = ?, 
+                item_status = ?,
+                updates_log = updates_log || ?,
+                received_date = CURRENT_TIMESTAMP,
+                last_updated = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', updates)
+        _refresh_shipments(c, shipment_refs)
         conn.commit()
     except Exception as e:
         print(f"Error receiving items: {e}")
+        conn.rollback()
+        return 0, {}
     finally:
         conn.close()
-        
-    return count, notifs
+
+    return len(updates), updates_by_advisor
 
 # --- Email Notification Logic ---
 import mailer
@@ -1134,145 +2020,169 @@ def notify_part_arrival(item_id):
         """
         mailer.send_email(email, subject, body)
 
-def generate_daily_advisor_brief():
+# Last "...eceived" log entry date (same rule as utils.get_days_in_stock)
+LAST_RECEIVED_LOG_PATTERN = r'(?s:.*)\[(\d{4}-\d{2}-\d{2})[^\n]*?\][^\n]*?eceived'
+
+def generate_daily_advisor_brief(max_workers=None):
     """
     Generates summary email for each advisor:
     1. Newly Arrived (Last 24h)
     2. Critical Aging (> 7 Days)
     3. Pending ETA (Today)
+    All advisors are computed in one vectorized pass; rendering and sending
+    run on a bounded thread pool (config.BRIEF_MAX_WORKERS).
+    Returns a dict: {'advisors': n, 'emails_sent': n}.
     """
     conn = get_connection()
-    c = conn.cursor()
     
-    # Get all active parts
-    query = "SELECT * FROM parts WHERE is_archived = 0" 
+    # Get all active parts (only the columns the brief needs; the log only when
+    # there is no received/stock date to age from)
+    query = """
+        SELECT service_advisor, item_no, item_description, customer_name, item_status, eta,
+               last_updated, received_date, custom_stock_date,
+               CASE WHEN item_status = 'Received' AND received_date IS NULL
+                         AND (custom_stock_date IS NULL OR custom_stock_date = '')
+                    THEN updates_log END AS updates_log
+        FROM parts
+        WHERE is_archived = 0
+        AND service_advisor IS NOT NULL AND service_advisor != '' AND service_advisor != 'Unknown'
+    """
     df = pd.read_sql(query, conn)
     conn.close()
     
+    summary = {'advisors': 0, 'emails_sent': 0}
     if df.empty:
-        return
-    
-    advisors = df['service_advisor'].dropna().unique()
+        return summary
+
+    now = datetime.now()
+    today = pd.Timestamp(now).normalize()
+    yesterday = now - timedelta(hours=24)
+    today_str = now.strftime('%Y-%m-%d')
+    is_received = df['item_status'] == 'Received'
+
+    # 1. Newly Arrived (Last 24h) - 'last_updated' is a proxy for the status change time
+    last_updated_dt = pd.to_datetime(df['last_updated'], errors='coerce')
+    df['is_new_arrival'] = is_received & (last_updated_dt >= yesterday)
+
+    # 2. Critical Aging (> 7 Days): custom stock date -> received date -> last 'Received' log entry
+    stock_date = pd.to_datetime(df['custom_stock_date'].astype(str).str[:10], errors='coerce')
+    stock_date = stock_date.fillna(pd.to_datetime(df['received_date'].astype(str).str[:10], errors='coerce'))
+    log_date = pd.to_datetime(df['updates_log'].str.extract(LAST_RECEIVED_LOG_PATTERN)[0], errors='coerce')
+    stock_date = stock_date.fillna(log_date)
+    df['aging_days'] = (today - stock_date).dt.days.clip(lower=0).fillna(0).astype(int)
+    df['is_critical'] = is_received & (df['aging_days'] > 7)
+
+    # 3. Pending ETA (Today) - ETA is YYYY-MM-DD
+    df['is_pending_eta'] = ~is_received & (df['eta'] == today_str)
+
+    report_df = df[df['is_new_arrival'] | df['is_critical'] | df['is_pending_eta']]
+    if report_df.empty:
+        return summary # Nothing to report
+
+    advisor_groups = list(report_df.groupby('service_advisor'))
+    summary['advisors'] = len(advisor_groups)
+
+    with ThreadPoolExecutor(max_workers=max_workers or config.BRIEF_MAX_WORKERS, thread_name_prefix='morning-brief') as pool:
+        futures = [pool.submit(deliver_advisor_brief, advisor, adv_df) for advisor, adv_df in advisor_groups]
+        for future in futures:
+            try:
+                summary['emails_sent'] += future.result()
+            except Exception as e:
+                print(f"Error sending Morning Brief: {e}")
+
+    return summary
+
+def render_advisor_brief(advisor, adv_df):
+    """
+    Renders the Morning Brief HTML for one advisor from the flagged rows.
+    """
+    new_arrivals = adv_df[adv_df['is_new_arrival']]
+    critical = adv_df[adv_df['is_critical']]
+    pending_eta = adv_df[adv_df['is_pending_eta']]
+
+    html = f"<h2>Morning Brief for {advisor}</h2>"
     
-    for advisor in advisors:
-        if not advisor or advisor == 'Unknown':
-            continue
-            
-        # Filter for this advisor
-        adv_df = df[df['service_advisor'] == advisor]
-        
-        # 1. Newly Arrived (Last 24h)
-        # We need to detect status change time. 'last_updated' is a proxy.
-        now = datetime.now()
-        yesterday = now - timedelta(hours=24)
+    if not new_arrivals.empty:
+        html += "<h3>Newly Arrived (Last 24h)</h3>"
+        html += new_arrivals[['item_no', 'item_description', 'customer_name']].to_html(index=False)
         
-        # Convert timestamp strings to datetime objects for comparison
-        # last_updated format: YYYY-MM-DD HH:MM:SS (SQLite default)
-        try:
-            adv_df['last_updated_dt'] = pd.to_datetime(adv_df['last_updated'])
-        except:
-            continue
+    if not critical.empty:
+        html += "<h3>Critical Aging (> 7 Days)</h3>"
+        html += critical[['item_no', 'customer_name', 'aging_days']].to_html(index=False)
 
-        new_arrivals = adv_df[
-            (adv_df['item_status'] == 'Received') & 
-            (adv_df['last_updated_dt'] >= yesterday)
-        ]
-        
-        # 2. Critical Aging (> 7 Days)
-        # Helper to calc days using utils
-        def get_days(log):
-             return utils.get_days_in_stock(log)
-        
-        adv_df['aging_days'] = adv_df['updates_log'].apply(get_days)
-        critical = adv_df[
-            (adv_df['item_status'] == 'Received') & 
-            (adv_df['aging_days'] > 7)
-        ]
-        
-        # 3. Pending ETA (Today)
-        # ETA is YYYY-MM-DD
-        today_str = now.strftime('%Y-%m-%d')
-        pending_eta = adv_df[
-            (adv_df['item_status'] != 'Received') & 
-            (adv_df['eta'] == today_str)
-        ]
-        
-        # Generate HTML
-        if new_arrivals.empty and critical.empty and pending_eta.empty:
-            continue # Nothing to report
-            
-        html = f"<h2>Morning Brief for {advisor}</h2>"
-        
-        if not new_arrivals.empty:
-            html += "<h3>Newly Arrived (Last 24h)</h3>"
-            html += new_arrivals[['item_no', 'item_description', 'customer_name']].to_html(index=False)
-            
-        if not critical.empty:
-            html += "<h3>Critical Aging (> 7 Days)</h3>"
-            html += critical[['item_no', 'customer_name', 'aging_days']].to_html(index=False)
+    if not pending_eta.empty:
+        html += "<h3>Pending Delivery Today</h3>"
+        html += pending_eta[['item_no', 'customer_name', 'item_status']].to_html(index=False)
 
-        if not pending_eta.empty:
-            html += "<h3>Pending Delivery Today</h3>"
-            html += pending_eta[['item_no', 'customer_name', 'item_status']].to_html(index=False)
-            
-        email = mailer.get_advisor_email(advisor)
-        mailer.send_email(email, f"Morning Brief: {advisor}", html)
+    return html
+
+def deliver_advisor_brief(advisor, adv_df):
+    """
+    Renders and sends one advisor's Morning Brief (one pool task per advisor).
+    Returns the number of emails sent.
+    """
+    return send_advisor_brief(advisor, render_advisor_brief(advisor, adv_df))
+
+def send_advisor_brief(advisor, html):
+    """
+    Sends one advisor's Morning Brief to every user with that advisor code.
+    Returns the number of emails sent.
+    """
+    sent = 0
+    for email, username in get_user_emails_by_advisor_code(advisor):
+        if mailer.send_email(email, f"Morning Brief: {advisor}", html):
+            sent += 1
+    return sent
 
 def remove_items_from_shipment(ids_to_remove, user_name):
     """
-    Removes items from specific shipment.
-    Logic:
-    - If item was created by 'Invoiced' (Source Invoiced) -> DELETE.
-    - If item was 'On Order' (Source OnOrder) -> REVERT status.
+    Removes items from specific shipment, in two set-based statements (one transaction).
+    Logic (by origin_source, the file that created the row):
+    - Created by an 'Invoiced' file -> DELETE.
+    - Existing 'OnOrder' / 'BackOrder' item -> REVERT status.
+    Returns (deleted_count, reverted_count).
     """
+    if not ids_to_remove:
+        return 0, 0
     conn = get_connection()
     c = conn.cursor()
     count_del = 0
     count_revert = 0
     now_str = datetime.now().strftime('%Y-%m-%d %H:%M')
+    sources_ph = ','.join('?' for _ in EXISTING_ORDER_SOURCES)
     
     try:
-        if not ids_to_remove:
-            return 0, 0
-
-        # Fetch details to decide action
-        placeholders = ','.join('?' for _ in ids_to_remove)
-        c.execute(f"SELECT id, source_file_type, received_qty, updates_log FROM parts WHERE id IN ({placeholders})", ids_to_remove)
-        rows = c.fetchall()
-        
-        for row in rows:
-            p_id = row[0]
-            src = row[1] 
-            log_text = row[3] or ""
-            
-            # Check for "Source: OnOrder" to determine if it's an existing item
-            is_existing_item = "Source: OnOrder" in log_text or "Source: BackOrder" in log_text
-            
-            if not is_existing_item:
-                # Created by this invoice -> DELETE
-                c.execute("DELETE FROM parts WHERE id = ?", (p_id,))
-                count_del += 1
-            else:
-                # Existing item -> REVERT
-                curr_recv = row[2] or 0
-                new_status = 'Partially Received' if curr_recv > 0 else 'On Order'
-                
-                log_entry = f"\n[{now_str}] {user_name}: Removed from Shipment (Reverted to {new_status})"
-                
-                c.execute('''
-                    UPDATE parts 
-                    SET item_status = ?,
-                        shipment_ref = NULL,
-                        in_transit_qty = 0,
-                        updates_log = updates_log || ?,
-                        last_updated = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (new_status, log_entry, p_id))
-                count_revert += 1
+        _stage_ids(c, ids_to_remove)
+        shipment_refs = _shipment_refs_of(c, ids_to_remove)
+
+        # Created by this invoice -> DELETE
+        c.execute(f'''
+            DELETE FROM parts
+            WHERE id IN (SELECT id FROM temp.staged_ids)
+              AND COALESCE(origin_source, 'Invoiced') NOT IN ({sources_ph})
+        ''', EXISTING_ORDER_SOURCES)
+        count_del = c.rowcount
+
+        # Existing item -> REVERT
+        c.execute(f'''
+            UPDATE parts 
+            SET item_status = CASE WHEN COALESCE(received_qty, 0) > 0 THEN 'Partially Received' ELSE 'On Order' END,
+                shipment_ref = NULL,
+                in_transit_qty = 0,
+                updates_log = updates_log || ?
+                    || CASE WHEN COALESCE(received_qty, 0) > 0 THEN 'Partially Received' ELSE 'On Order' END || ')',
+                last_updated = CURRENT_TIMESTAMP
+            WHERE id IN (SELECT id FROM temp.staged_ids)
+              AND origin_source IN ({sources_ph})
+        ''', (f"\n[{now_str}] {user_name}: Removed from Shipment (Reverted to ",) + EXISTING_ORDER_SOURCES)
+        count_revert = c.rowcount
+        _refresh_shipments(c, shipment_refs)
         
         conn.commit()
     except Exception as e:
         print(f"Error removing items: {e}")
+        conn.rollback()
+        return 0, 0
     finally:
         conn.close()
         
@@ -1289,22 +2199,18 @@ def archive_by_document_no(document_no, user_name):
     count = 0
     
     try:
-        # Find active items with this document_no
-        c.execute("SELECT count(*) FROM parts WHERE document_no = ? AND is_archived = 0", (document_no,))
-        count = c.fetchone()[0]
-        
-        if count > 0:
-            log_entry = f"\n[{now_str}] {user_name}: Bulk Posted (Document: {document_no})"
-            c.execute('''
-                UPDATE parts 
-                SET is_archived = 1,
-                    item_status = 'Posted',
-                    posted_at = ?,
-                    updates_log = updates_log || ?,
-                    last_updated = CURRENT_TIMESTAMP
-                WHERE document_no = ? AND is_archived = 0
-            ''', (now_str, log_entry, document_no))
-            conn.commit()
+        # Move active items with this document_no to the archive
+        log_entry = f"\n[{now_str}] {user_name}: Bulk Posted (Document: {document_no})"
+        moved = _move_parts(c, 'parts', 'parts_archive', "document_no = ?", (document_no,), {
+            'is_archived': ('1', ()),
+            'item_status': ("'Posted'", ()),
+            'posted_at': ('?', (now_str,)),
+            'updates_log': ("updates_log || ?", (log_entry,)),
+            'last_updated': ('CURRENT_TIMESTAMP', ()),
+        }, returning=['shipment_ref'])
+        _refresh_shipments(c, [row['shipment_ref'] for row in moved])
+        count = len(moved)
+        conn.commit()
             
     except Exception as e:
         print(f"Error bulk posting: {e}")
@@ -1316,21 +2222,27 @@ def archive_by_document_no(document_no, user_name):
 
 # --- Ledger / History ---
 
-def get_item_details(item_no_query, user_type='admin', service_advisor_code=None):
-    """
-    Search for parts by Item No (partial match), filtered by user permissions.
-    Returns basic info + updates_log.
-    """
-    conn = get_connection()
-    c = conn.cursor()
-    
-    # Base Query
-    query = '''
-        SELECT * FROM parts 
-        WHERE (item_no LIKE ? OR order_no LIKE ? OR customer_name LIKE ?)
+def build_item_search_query(item_no_query, user_type='admin', service_advisor_code=None, select='p.*'):
+    """
+    Builds the Ledger search SQL (FTS lookup joined back to active AND archived
+    parts) with the permission filter applied. Rows expose p.search_rank (FTS rank).
+    Returns (query, params) without ORDER BY.
+    """
+    fts_table, match = build_search_match(item_no_query)
+    query = f'''
+        SELECT {select} FROM (
+            SELECT parts.*, f.rank AS search_rank FROM {fts_table} f
+            JOIN parts ON parts.id = f.rowid
+            WHERE {fts_table} MATCH ?
+            UNION ALL
+            SELECT parts_archive.*, f.rank AS search_rank FROM {fts_table} f
+            JOIN parts_archive ON parts_archive.id = f.rowid
+            WHERE {fts_table} MATCH ?
+        ) p
+        WHERE 1 = 1
     '''
-    params = [f"%{item_no_query}%", f"%{item_no_query}%", f"%{item_no_query}%"]
-    
+    params = [match, match]
+
     # Role Logic (Mirroring get_parts_view)
     # user_type might be "admin,super_admin" or just "PRTADV"
     # Ensure we split and check safely
@@ -1340,17 +2252,33 @@ def get_item_details(item_no_query, user_type='admin', service_advisor_code=None
     if 'admin' in roles or 'super_admin' in roles or 'Read Only' in roles:
         pass # View All
     elif 'A' in roles or 'PRTADV' in roles or 'SADV' in roles:
-        query += " AND service_advisor != 'OTC'"
+        query += " AND p.service_advisor != 'OTC'"
     elif 'SaMnagment' in roles:
-        query += " AND service_advisor IN ('EMA GilbetZ', 'EMB TonyR', 'EMC JackS')"
+        query += " AND p.service_advisor IN ('EMA GilbetZ', 'EMB TonyR', 'EMC JackS')"
     elif 'OTC' in roles:
-        query += " AND service_advisor = 'OTC'"
+        query += " AND p.service_advisor = 'OTC'"
     else:
         # Default / Type B
-        query += " AND service_advisor = ?"
+        query += " AND p.service_advisor = ?"
         params.append(service_advisor_code)
-        
-    query += " ORDER BY id DESC"
+
+    return query, params
+
+def get_item_details(item_no_query, user_type='admin', service_advisor_code=None, limit=None, offset=0):
+    """
+    Search for parts by Item No, Order No, Customer, Document No, VIN or Description
+    via the FTS index, filtered by user permissions. Best matches first.
+    Optional limit/offset return a single page of results.
+    Returns basic info + updates_log.
+    """
+    conn = get_connection()
+    c = conn.cursor()
+
+    query, params = build_item_search_query(item_no_query, user_type, service_advisor_code)
+    query += " ORDER BY p.search_rank, p.id DESC"
+    if limit:
+        query += " LIMIT ? OFFSET ?"
+        params += [limit, offset]
     
     c.execute(query, params)
     
@@ -1359,10 +2287,76 @@ def get_item_details(item_no_query, user_type='admin', service_advisor_code=None
     # Get columns
     cols = [description[0] for description in c.description]
     df = pd.DataFrame(rows, columns=cols)
-    
+
     conn.close()
     return df
 
+def count_item_matches(item_no_query, user_type='admin', service_advisor_code=None):
+    """
+    Returns the total number of parts matching a Ledger search.
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    query, params = build_item_search_query(item_no_query, user_type, service_advisor_code, select='COUNT(*)')
+    c.execute(query, params)
+    count = c.fetchone()[0]
+    conn.close()
+    return count
+
+# Ledger match counts: (search, role, advisor, data_version, today) -> Future, shared by
+# every session of this process like get_ledger_page's cache. Counts of older data
+# versions (or days) are dropped as soon as a newer one starts.
+_ledger_counts = {}
+_ledger_counts_lock = threading.Lock()
+LEDGER_COUNT_CACHE_SIZE = 200
+
+def get_ledger_count(item_no_query, user_type, service_advisor_code, data_version, today):
+    """
+    Returns a Future for count_item_matches. The count starts in the background the
+    first time and is reused until the data version or the day changes, so callers can
+    render the first page without waiting and show the total once future.done().
+    """
+    key = (item_no_query, user_type, service_advisor_code, data_version, today)
+    with _ledger_counts_lock:
+        future = _ledger_counts.get(key)
+        if future is None or (future.done() and future.exception() is not None):
+            for stale in [k for k in _ledger_counts if k[3:] != (data_version, today)]:
+                del _ledger_counts[stale]
+            if len(_ledger_counts) >= LEDGER_COUNT_CACHE_SIZE:
+                del _ledger_counts[next(iter(_ledger_counts))] # Oldest entry
+            future = _background_executor.submit(count_item_matches, item_no_query, user_type, service_advisor_code)
+            _ledger_counts[key] = future
+    return future
+
+@st.cache_data(max_entries=200, show_spinner=False)
+def get_ledger_page(search_term, user_type, service_advisor_code, offset, limit, data_version, today):
+    """
+    Returns (item_count, ledger_df) for one page of a Ledger search.
+    Cached per page until the data version or the day changes (`today`: the Duration
+    column counts up to today).
+    """
+    results = get_item_details(search_term, user_type, service_advisor_code, limit=limit, offset=offset)
+    return len(results), utils.build_ledger_events(results)
+
+def iter_ledger_pages(search_term, user_type, service_advisor_code, data_version, today, page_size=None, max_results=None):
+    """
+    Generator over a Ledger search: yields (item_count, ledger_df) one page at a time,
+    so callers only load the pages they display. Stops at max_results items.
+    Defaults come from config.LEDGER_PAGE_SIZE / config.LEDGER_MAX_RESULTS.
+    """
+    page_size = page_size or config.LEDGER_PAGE_SIZE
+    max_results = max_results or config.LEDGER_MAX_RESULTS
+    offset = 0
+    while offset < max_results:
+        limit = min(page_size, max_results - offset)
+        item_count, ledger_df = get_ledger_page(search_term, user_type, service_advisor_code, offset, limit, data_version, today)
+        if item_count == 0:
+            return
+        yield item_count, ledger_df
+        if item_count < limit:
+            return
+        offset += item_count
+
 def mark_remarks_as_read(part_id, user_name):
     """
     Marks all remarks for a part as read.
@@ -1396,149 +2390,204 @@ def get_dashboard_metrics():
     
     metrics = {}
     
+    # Read from the maintained counters (one row per group, no table scan)
     # 1. Active Orders Count (Not Archived)
-    c.execute("SELECT COUNT(*) FROM parts WHERE is_archived = 0")
-    metrics['active_orders'] = c.fetchone()[0]
-    
     # 2. Car Down Count
-    c.execute("SELECT COUNT(*) FROM parts WHERE cardown LIKE 'Yes%' AND is_archived = 0")
-    metrics['car_down'] = c.fetchone()[0]
-    
     # 3. Received (In Stock) Count
-    c.execute("SELECT COUNT(*) FROM parts WHERE item_status = 'Received' AND is_archived = 0")
-    metrics['received_count'] = c.fetchone()[0]
+    c.execute('''
+        SELECT COALESCE(SUM(count), 0),
+               COALESCE(SUM(CASE WHEN is_cardown = 1 THEN count ELSE 0 END), 0),
+               COALESCE(SUM(CASE WHEN item_status = 'Received' THEN count ELSE 0 END), 0)
+        FROM parts_counters
+    ''')
+    metrics['active_orders'], metrics['car_down'], metrics['received_count'] = c.fetchone()
     
     conn.close()
     return metrics
 
-def get_stale_stock_candidates(days_threshold=7):
+def get_stale_stock_candidates(days_threshold=None, rewarn_days=None):
     """
-    Returns list of items that are 'Received' and have been so for > days_threshold.
-    Calculates duration by parsing updates_log.
+    Returns items that are 'Received' and have been so for >= days_threshold,
+    grouped by advisor: {service_advisor: [item, ...]}.
+    Days in stock come from custom_stock_date -> received_date -> last_updated (in SQL).
+    Items warned within the last rewarn_days (last_reminder_sent) are skipped.
+    Defaults come from config.STALE_STOCK_DAYS / config.STALE_STOCK_REWARN_DAYS.
     """
+    if days_threshold is None:
+        days_threshold = config.STALE_STOCK_DAYS
+    if rewarn_days is None:
+        rewarn_days = config.STALE_STOCK_REWARN_DAYS
+
     conn = get_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     
     c.execute('''
-        SELECT * FROM parts 
-        WHERE item_status = 'Received' 
-        AND is_archived = 0
-    ''')
+        SELECT * FROM (
+            SELECT id, item_no, item_description, customer_name, customer_no,
+                   order_no, document_no, service_advisor, last_reminder_sent,
+                   CAST(julianday(date('now', 'localtime')) - julianday(COALESCE(
+                       date(NULLIF(custom_stock_date, '')),
+                       date(COALESCE(received_date, last_updated), 'localtime') -- UTC CURRENT_TIMESTAMP
+                   )) AS INTEGER) AS days_in_stock
+            FROM parts
+            WHERE item_status = 'Received'
+            AND is_archived = 0
+            -- Calendar days (local), not exact timestamps: the reminder is stamped after
+            -- sending, so the next daily run starts "earlier" in the day than it
+            AND (last_reminder_sent IS NULL
+                 OR date(last_reminder_sent, 'localtime') <= date('now', 'localtime', ?))
+        )
+        WHERE days_in_stock >= ?
+        ORDER BY service_advisor, days_in_stock DESC
+    ''', (f'-{int(rewarn_days)} days', days_threshold))
     rows = c.fetchall()
     conn.close()
-    
-    stale_items = []
-    
+
+    stale_by_advisor = {}
     for row in rows:
-        # Get duration integer
-        log = row['updates_log']
-        custom_date = row.get('custom_stock_date') # might wait need to ensure col exists in row (it does via select *)
-        aging_text = utils.get_aging_text(log, 'Received', custom_date) # e.g. "IS 5 days"
-        
-        # Parse int
-        days = 0
-        if 'IS' in aging_text and 'days' in aging_text:
-            try:
-                days = int(aging_text.split()[1])
-            except:
-                days = 0
-                
-        if days >= days_threshold:
-            # Check if warning was sent recently? (Optional, skipping for now to allow manual re-trigger)
-            item = dict(row)
-            item['days_in_stock'] = days
-            stale_items.append(item)
+        item = dict(row)
+        stale_by_advisor.setdefault(item['service_advisor'], []).append(item)
             
-    return stale_items
+    return stale_by_advisor
+
+def send_stale_stock_warnings(days_threshold=None, rewarn_days=None):
+    """
+    Emails stale stock warnings (see get_stale_stock_candidates).
+    Candidates are grouped per recipient email (one email even if the recipient covers
+    several advisor codes) and sent over a single SMTP session. Items that reached at least
+    one recipient get last_reminder_sent stamped in one batched update, so they are not
+    re-warned before rewarn_days. Returns the number of items warned.
+    """
+    if days_threshold is None:
+        days_threshold = config.STALE_STOCK_DAYS
+    stale_by_advisor = get_stale_stock_candidates(days_threshold, rewarn_days)
+    if not stale_by_advisor:
+        return 0
+
+    recipients_by_advisor = get_user_emails_by_advisor_codes(stale_by_advisor.keys())
+    by_recipient = {} # email -> {'name': username, 'items': {id: item}}
+    for advisor, items in stale_by_advisor.items():
+        recipients = recipients_by_advisor.get(advisor)
+        if not recipients:
+            print(f"Stale stock: no recipient email for advisor '{advisor}' ({len(items)} items).")
+            continue
+        for email, username in recipients:
+            entry = by_recipient.setdefault(email, {'name': username, 'items': {}})
+            entry['items'].update((item['id'], item) for item in items)
+
+    if not by_recipient:
+        return 0
+
+    warned_ids = set()
+    with mailer.smtp_session() as server:
+        for email, entry in by_recipient.items():
+            items = sorted(entry['items'].values(), key=lambda i: i['days_in_stock'], reverse=True)
+            if mailer.send_stale_stock_warning(email, items, advisor_name=entry['name'],
+                                               days_threshold=days_threshold, server=server):
+                warned_ids.update(entry['items'])
+
+    update_last_reminder(list(warned_ids))
+    return len(warned_ids)
 
 def update_last_reminder(item_ids):
     """
     Updates the last_reminder_sent timestamp for a list of item IDs.
+    One statement regardless of list size (ids passed as a single JSON array).
     """
     if not item_ids: return
     conn = get_connection()
     c = conn.cursor()
-    placeholders = ','.join('?' for _ in item_ids)
-    c.execute(f'''
+    c.execute('''
         UPDATE parts 
         SET last_reminder_sent = CURRENT_TIMESTAMP 
-        WHERE id IN ({placeholders})
-    ''', item_ids)
+        WHERE id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps([int(i) for i in item_ids]),))
     conn.commit()
     conn.close()
 
 # --- Advanced Analytics ---
-def get_top_ordered_parts(limit=10):
+def get_top_ordered_parts(limit=10, conn=None):
     """
     Returns data for the Top N most ordered part numbers.
     Aggregate across ALL history (active + archived).
+    Pass an open conn to reuse it (it is left open).
     """
-    conn = get_connection()
+    own_conn = conn is None
+    if own_conn:
+        conn = get_connection()
     # Normalize Item No (remove spaces, uppercase)
     # Simple Group By
     df = pd.read_sql_query('''
         SELECT item_no, item_description, COUNT(*) as frequency, SUM(ordered_qty) as total_qty
-        FROM parts
+        FROM parts_all
         GROUP BY item_no
         ORDER BY frequency DESC
         LIMIT ?
     ''', conn, params=(limit,))
-    conn.close()
+    if own_conn:
+        conn.close()
     return df
 
 # --- Backup / Restore System ---
-import shutil
+# Restore points are chunked, deduplicated images (see backup_store.py).
+# Rows whose file_path is a legacy full .db copy remain restorable.
+import backup_store
 
-def create_database_backup(user_name):
+def create_database_backup(user_name, skip_unchanged=False):
     """
-    Creates a copy of the current DB file to the backups/ folder 
+    Takes an online snapshot of the current DB as an incremental restore point
     and logs it in the database_backups table.
+    skip_unchanged: take no snapshot if the data_changes counter has not moved since the
+    latest restore point (scheduled backups; returns success with a "skipped" message).
     """
     print(f"DEBUG: Starting backup creation for {user_name}...")
     
     if not config.DB_PATH.exists():
         print(f"DEBUG: DB file not found at {config.DB_PATH}")
         return False, "Database file not found."
+
+    # Read before the snapshot, so the snapshot holds at least every change counted here
+    change_count = get_change_count()
+    if skip_unchanged:
+        if change_count is not None and change_count == backup_store.load_source_signature():
+            print("DEBUG: Database unchanged since the latest restore point, backup skipped.")
+            return True, "Backup skipped: no changes since the latest restore point."
         
-    backup_dir = config.DATA_DIR / "backups"
-    backup_dir.mkdir(exist_ok=True)
-    print(f"DEBUG: Backup directory: {backup_dir}")
-    
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_filename = f"backup_{timestamp}_{user_name}.db"
-    backup_path = backup_dir / backup_filename
-    print(f"DEBUG: Target backup path: {backup_path}")
+    backup_name = f"backup_{timestamp}_{user_name}"
+    suffix = 1
+    while (backup_store.backup_dir() / f"{backup_name}.json").exists(): # Same second, same user
+        suffix += 1
+        backup_name = f"backup_{timestamp}_{user_name}_{suffix}"
     
+    conn = get_connection()
     try:
-        # 1. Copy file
-        shutil.copy2(config.DB_PATH, backup_path)
-        print("DEBUG: File copy successful.")
+        # 1. Snapshot -> shared chunks + manifest
+        manifest_path, stats = backup_store.create_restore_point(config.DB_PATH, backup_name)
+        print(f"DEBUG: Snapshot stored: {stats['new_chunks']}/{stats['chunks']} new chunks, {stats['bytes_written']} bytes written.")
         
         # 2. Log to DB
-        conn = get_connection()
-        c = conn.cursor()
-        
-        # Ensure table exists (just in case)
-        c.execute('''CREATE TABLE IF NOT EXISTS database_backups
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      name TEXT,
-                      file_path TEXT,
-                      created_by TEXT,
-                      timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-        c.execute('''
-            INSERT INTO database_backups (name, file_path, created_by)
-            VALUES (?, ?, ?)
-        ''', (backup_filename, str(backup_path), user_name))
+        conn.execute('''
+            INSERT INTO database_backups (name, file_path, created_by, checksum)
+            VALUES (?, ?, ?, ?)
+        ''', (manifest_path.name, str(manifest_path), user_name, backup_store.file_sha256(manifest_path)))
         conn.commit()
-        conn.close()
+        backup_store.save_source_signature(change_count)
         print("DEBUG: DB log insertion successful.")
+
+        # 3. Chunks the newest restore point no longer uses are cold: compress them
+        try:
+            backup_store.compress_cold_chunks(manifest_path)
+        except Exception as e:
+            print(f"DEBUG: Cold chunk compression failed: {e}")
         
-        return True, f"Backup created: {backup_filename}"
+        return True, f"Backup created: {backup_name}"
     except Exception as e:
         print(f"DEBUG: Backup failed with error: {e}")
         return False, str(e)
+    finally:
+        conn.close()
 
 def get_available_backups():
     """Returns list of backups from DB table."""
@@ -1554,31 +2603,91 @@ def restore_database_backup(backup_id):
     """
     Restores the database from a backup file.
     DANGEROUS: Overwrites current DB.
+    1. Integrity-checks the backup (read-only).
+    2. Takes a 'pre-restore' safety backup of the current state.
+    3. Holds new connections (this process) and copies the backup into the live
+       database in one backup-API transaction, so other open connections and the
+       scheduler process see either the old or the restored data, never a mix.
+    The backup registry itself is kept as it is now, so newer restore points stay listed.
     """
     conn = get_connection()
     c = conn.cursor()
-    c.execute("SELECT file_path FROM database_backups WHERE id = ?", (backup_id,))
+    c.execute("SELECT file_path, checksum FROM database_backups WHERE id = ?", (backup_id,))
     res = c.fetchone()
     conn.close()
     
     if not res:
         return False, "Backup record not found."
         
-    backup_path = Path(res[0])
+    try:
+        backup_path = backup_store.resolve_backup_path(res[0])
+    except ValueError as e:
+        return False, str(e)
     if not backup_path.exists():
         return False, "Backup file missing from disk."
-        
-    # Safety: Make a temporary 'pre-restore' backup just in case? 
-    # Let's skip complexity for MVP, but user asked for safety.
-    # The user logic is: "I screwed up, go back".
-    
+    if res[1] and backup_store.file_sha256(backup_path) != res[1]:
+        return False, "Backup file checksum mismatch."
+
+    # Incremental restore points are reassembled into a staging file first
+    staged_path = None
+    if backup_store.is_manifest(backup_path):
+        staged_path = backup_store.backup_dir() / f"restore_{backup_id}.staging"
+        try:
+            backup_store.materialize(backup_path, staged_path)
+        except Exception as e:
+            staged_path.unlink(missing_ok=True)
+            return False, f"Could not rebuild backup: {e}"
+        backup_path = staged_path
+
     try:
-        # 1. Close connections (Streamlit might hold one, but we closed ours)
-        # 2. Copy backup -> live
-        shutil.copy2(backup_path, config.DB_PATH)
-        return True, "Database restored successfully. Please refresh."
+        return _restore_from_file(backup_path)
+    finally:
+        if staged_path is not None:
+            staged_path.unlink(missing_ok=True)
+
+def _restore_from_file(backup_path):
+    """Checks a full database file and copies it into the live DB (see restore_database_backup)."""
+    try:
+        check = backup_store.integrity_check(backup_path)
+        if check != 'ok':
+            return False, f"Backup failed integrity check: {check}"
+    except sqlite3.DatabaseError as e:
+        return False, f"Backup is not a valid database: {e}"
+
+    success, msg = create_database_backup("pre-restore")
+    if not success:
+        return False, f"Could not take a safety backup before restoring: {msg}"
+
+    _not_in_maintenance.clear()
+    try:
+        src = sqlite3.connect(f"{backup_path.as_uri()}?mode=ro", uri=True)
+        dst = sqlite3.connect(config.DB_PATH, timeout=60.0)
+        try:
+            registry = dst.execute("SELECT id, name, timestamp, file_path, created_by, checksum FROM database_backups").fetchall()
+            src.backup(dst) # Single step: one write transaction on the live DB
+            dst.execute('''CREATE TABLE IF NOT EXISTS database_backups
+                           (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT,
+                            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                            file_path TEXT UNIQUE, created_by TEXT)''')
+            columns = [r[1] for r in dst.execute("PRAGMA table_info(database_backups)")]
+            if 'checksum' not in columns: # Backup predates checksums
+                dst.execute("ALTER TABLE database_backups ADD COLUMN checksum TEXT")
+            dst.execute("DELETE FROM database_backups")
+            dst.executemany("INSERT INTO database_backups (id, name, timestamp, file_path, created_by, checksum) VALUES (?, ?, ?, ?, ?, ?)", registry)
+            dst.commit()
+        finally:
+            dst.close()
+            src.close()
     except Exception as e:
         return False, f"Restore failed: {e}"
+    finally:
+        _not_in_maintenance.set()
+
+    backup_store.save_source_signature(None) # The restored counter says nothing about the latest restore point
+    init_db() # Bring older backups up to the current schema
+    st.cache_data.clear()
+    invalidate_unread_notifications()
+    return True, "Database restored successfully. Please refresh."
 
 def delete_database_backup(backup_id):
     """
@@ -1593,13 +2702,20 @@ def delete_database_backup(backup_id):
         conn.close()
         return False, "Backup record not found."
 
-    file_path = Path(res[0])
     backup_name = res[1]
+    try:
+        file_path = backup_store.resolve_backup_path(res[0])
+    except ValueError as e:
+        # Never delete files outside the backups folder; just drop the bad record
+        print(f"Not deleting file for backup '{backup_name}': {e}")
+        file_path = None
 
-    # 1. Delete physical file (ignore if already missing)
+    # 1. Delete physical file (ignore if already missing), plus any -wal/-shm left by a legacy .db copy
     try:
-        if file_path.exists():
-            file_path.unlink()
+        if file_path is not None:
+            file_path.unlink(missing_ok=True)
+            for sidecar in ('-wal', '-shm'):
+                file_path.with_name(file_path.name + sidecar).unlink(missing_ok=True)
     except Exception as e:
         conn.close()
         return False, f"Could not delete file: {e}"
@@ -1612,9 +2728,89 @@ def delete_database_backup(backup_id):
         conn.close()
         return False, f"Could not remove DB record: {e}"
 
+    # 3. Drop chunks no remaining restore point uses
+    if file_path is not None and backup_store.is_manifest(file_path):
+        remaining = [r[0] for r in c.execute("SELECT file_path FROM database_backups").fetchall()]
+        try:
+            backup_store.collect_garbage([p for p in remaining if backup_store.is_manifest(p)])
+        except Exception as e:
+            print(f"Backup chunk cleanup failed: {e}")
+
     conn.close()
     return True, f"Backup '{backup_name}' deleted successfully."
 
+def prune_backups(now=None):
+    """
+    Applies the backup retention policy (backup_store.retention_keep_ids): deletes the
+    files and database_backups rows of every restore point the policy does not keep,
+    then removes chunks no remaining restore point uses.
+    Returns the number of restore points pruned.
+    """
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None) # database_backups.timestamp is CURRENT_TIMESTAMP (UTC)
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        rows = c.execute("SELECT id, timestamp, file_path FROM database_backups").fetchall()
+        dated = []
+        for backup_id, ts, _ in rows:
+            try:
+                dated.append((backup_id, datetime.strptime(ts, '%Y-%m-%d %H:%M:%S')))
+            except (TypeError, ValueError):
+                pass # Unreadable timestamp: never pruned
+        keep = backup_store.retention_keep_ids(dated, now)
+        dated_ids = {backup_id for backup_id, _ in dated}
+        prune = [(backup_id, path) for backup_id, _, path in rows
+                 if backup_id in dated_ids and backup_id not in keep]
+        if not prune:
+            return 0
+
+        removed = []
+        for backup_id, path in prune:
+            try:
+                file_path = backup_store.resolve_backup_path(path)
+            except ValueError as e:
+                print(f"Not deleting file for backup {backup_id}: {e}")
+                removed.append(backup_id) # Drop the bad record, as delete_database_backup does
+                continue
+            try:
+                file_path.unlink(missing_ok=True)
+                for sidecar in ('-wal', '-shm'):
+                    file_path.with_name(file_path.name + sidecar).unlink(missing_ok=True)
+                removed.append(backup_id)
+            except OSError as e:
+                print(f"Could not delete file for backup {backup_id}, kept for the next run: {e}")
+        # Only rows whose files are gone, so the registry never points at missing files
+        c.execute("DELETE FROM database_backups WHERE id IN (SELECT value FROM json_each(?))",
+                  (json.dumps(removed),))
+        conn.commit()
+
+        remaining = [r[0] for r in c.execute("SELECT file_path FROM database_backups").fetchall()]
+        backup_store.collect_garbage([p for p in remaining if backup_store.is_manifest(p)])
+        return len(removed)
+    finally:
+        conn.close()
+
+def verify_backups(max_workers=None):
+    """
+    Verifies every registered restore point (file checksums, then every distinct
+    chunk hashed once in parallel, integrity check for legacy copies; see
+    backup_store.verify_all), then rebuilds the newest incremental restore point and
+    integrity-checks it (backup_store.check_image). Returns a list of
+    {'id', 'name', 'ok', 'error'} dicts, one per backup.
+    """
+    conn = get_connection()
+    rows = conn.execute("SELECT id, name, file_path, checksum FROM database_backups ORDER BY id").fetchall()
+    conn.close()
+
+    errors = backup_store.verify_all([(r[2], r[3]) for r in rows], max_workers)
+    newest = max((i for i, r in enumerate(rows) if backup_store.is_manifest(r[2]) and errors[i] is None), default=None)
+    if newest is not None:
+        errors[newest] = backup_store.check_image(backup_store.resolve_backup_path(rows[newest][2]))
+    return [
+        {'id': r[0], 'name': r[1], 'ok': error is None, 'error': error}
+        for r, error in zip(rows, errors)
+    ]
+
 def create_backup(user_name):
     return create_database_backup(user_name)
 
@@ -1624,11 +2820,11 @@ def get_analytics_data():
     """
     conn = get_connection()
     
-    # 1. Status Distribution
-    status_df = pd.read_sql("SELECT item_status, COUNT(*) as count FROM parts WHERE is_archived = 0 GROUP BY item_status", conn)
+    # 1. Status Distribution (from maintained counters)
+    status_df = pd.read_sql("SELECT NULLIF(item_status, '') as item_status, SUM(count) as count FROM parts_counters WHERE count > 0 GROUP BY item_status", conn)
     
-    # 2. Advisor Workload
-    adv_df = pd.read_sql("SELECT service_advisor, item_status, COUNT(*) as count FROM parts WHERE is_archived = 0 AND service_advisor IS NOT NULL AND service_advisor != 'Unknown' GROUP BY service_advisor, item_status", conn)
+    # 2. Advisor Workload (from maintained counters)
+    adv_df = pd.read_sql("SELECT service_advisor, NULLIF(item_status, '') as item_status, SUM(count) as count FROM parts_counters WHERE count > 0 AND service_advisor != '' AND service_advisor != 'Unknown' GROUP BY service_advisor, item_status", conn)
     
     # 3. Car Down List
     cardown_df = pd.read_sql("SELECT item_no, item_description, customer_name, service_advisor, eta, last_updated FROM parts WHERE is_archived = 0 AND cardown = 'Yes' ORDER BY last_updated ASC", conn)
@@ -1645,69 +2841,48 @@ def get_analytics_data():
         'top_customers': top_cust_df
     }
 
-def get_problem_items(days_threshold=10):
+def get_problem_items(days_threshold=10, conn=None):
     """
-    Returns items that are problematic:
+    Returns a DataFrame of items that are problematic:
     - Status 'Back Order' OR 'Received'
     - Aging > threshold days
+    Columns: id, item_no, item_description, item_status, days_aging, service_advisor, customer_name
+    Pass an open conn to reuse it (it is left open).
     """
-    conn = get_connection()
-    # optimized query
-    # We need to compute aging.
-    # For 'Received': days_in_stock
-    # For 'Back Order': days since... creation? or last update?
-    # Let's rely on Python logic for complex aging parsing if needed, but SQL is faster.
-    # We have 'last_updated'. simpler proxy for 'Back Order': time since last update?
-    # Or time since creation?
-    # 'updates_log' contains the history.
-    # Let's fetch candidates and filter in Python using utils.get_days_in_stock logic 
-    # (which handles log parsing for 'Received').
-    # For Back Order, maybe we just use (Now - last_updated)? Or (Now - Created)?
-    # Let's use (Now - last_updated) as proxy for "No movement".
-    
+    own_conn = conn is None
+    if own_conn:
+        conn = get_connection()
+
+    # Aging is computed in SQL from the transition-date columns:
+    # - Received:   custom_stock_date -> received_date -> last_updated
+    # - Back Order: back_order_original_date -> last_updated
+    # custom_stock_date / back_order_original_date are local dates entered by users;
+    # received_date / last_updated are CURRENT_TIMESTAMP (UTC), so they are converted
+    # to local time to compare with 'now', 'localtime'.
+    # Only rows over the threshold (and only the displayed columns) leave SQLite.
     query = """
-        SELECT * FROM parts 
-        WHERE is_archived = 0 
-        AND item_status IN ('Back Order', 'Received')
+        SELECT * FROM (
+            SELECT id, item_no, item_description, item_status,
+                   CAST(julianday('now', 'localtime') - (
+                       CASE WHEN item_status = 'Received'
+                            THEN COALESCE(julianday(NULLIF(custom_stock_date, '')),
+                                          julianday(COALESCE(received_date, last_updated), 'localtime'))
+                            ELSE COALESCE(julianday(NULLIF(back_order_original_date, '')),
+                                          julianday(last_updated, 'localtime'))
+                       END
+                   ) AS INTEGER) AS days_aging,
+                   service_advisor, customer_name
+            FROM parts
+            WHERE is_archived = 0
+            AND item_status IN ('Back Order', 'Received')
+        )
+        WHERE days_aging > ?
+        ORDER BY days_aging DESC
     """
-    df = pd.read_sql(query, conn)
-    conn.close()
-    
-    problem_items = []
-    
-    if df.empty:
-        return problem_items
-        
-    for _, row in df.iterrows():
-        status = row['item_status']
-        days = 0
-        
-        if status == 'Received':
-            # Use strict "Days in Stock" logic
-            days = utils.get_days_in_stock(row['updates_log'])
-        else:
-            # Back Order Aging
-            # prioritized: back_order_original_date -> last_updated
-            try:
-                if row.get('back_order_original_date'):
-                    # Use explicit date
-                    start_date = pd.to_datetime(row['back_order_original_date'])
-                else:
-                    # Fallback
-                    start_date = pd.to_datetime(row['last_updated'])
-                    
-                delta = datetime.now() - start_date
-                days = delta.days
-            except:
-                days = 0
-                
-        if days > days_threshold:
-            # Add to list
-            item = row.to_dict()
-            item['days_aging'] = days
-            problem_items.append(item)
-            
-    return problem_items
+    df = pd.read_sql(query, conn, params=(days_threshold,))
+    if own_conn:
+        conn.close()
+    return df
 
 def add_update_log(item_id, message, username):
     """
@@ -1727,36 +2902,83 @@ def add_update_log(item_id, message, username):
     finally:
         conn.close()
 
-def add_notification(message, target_advisor_code=None):
+def update_eta_bulk(item_ids, new_eta, username="Admin"):
     """
-    Adds a notification to the notifications table.
+    Updates the ETA of many items at once: the update, log entries and one notification
+    per advisor are written in a single transaction, then each advisor's recipients get
+    ONE consolidated email (over one SMTP session).
+    Items whose ETA is already new_eta are skipped.
+    Returns (updated_count, message).
     """
-    # Skipping implementation for now if table doesn't exist or not used yet?
-    # Or implement simply if needed. The error suggested it was called.
-    # Check if 'notifications' table exists? Assume yes or handle gracefully.
-    conn = get_connection() 
+    if len(item_ids) == 0:
+        return 0, "No items selected."
+    new_eta = str(new_eta)
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
+
+    conn = get_connection()
     c = conn.cursor()
     try:
-        # Check if table exists
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='notifications'")
-        if not c.fetchone():
-            # Create if needed
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS notifications (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    message TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_read INTEGER DEFAULT 0,
-                    target_user TEXT -- optional
-                )
-            ''')
-            
-        c.execute("INSERT INTO notifications (message, target_user) VALUES (?, ?)", (message, target_advisor_code))
+        _stage_ids(c, item_ids)
+        changed_sql = "id IN (SELECT id FROM temp.staged_ids) AND COALESCE(CAST(eta AS TEXT), 'None') != ?"
+        c.execute(f'''
+            SELECT item_no, item_description, service_advisor, eta, customer_name, shipment_ref
+            FROM parts WHERE {changed_sql}
+        ''', (new_eta,))
+        changed = c.fetchall()
+        if not changed:
+            conn.rollback()
+            return 0, "No change."
+
+        # Log entry built in SQL so each row records its own old ETA
+        c.execute(f'''
+            UPDATE parts
+            SET updates_log = updates_log || ? || COALESCE(CAST(eta AS TEXT), 'None') || ?,
+                eta = ?,
+                last_updated = CURRENT_TIMESTAMP
+            WHERE {changed_sql}
+        ''', (f"\n[{timestamp}] {username}: ETA updated from '", f"' to '{new_eta}' by {username}", new_eta, new_eta))
+        _refresh_shipments(c, [row[5] for row in changed])
+
+        items_by_advisor = {}
+        for item_no, desc, advisor, old_eta, customer, _ in changed:
+            if advisor and advisor != 'Unknown':
+                items_by_advisor.setdefault(advisor, []).append({
+                    'item_no': item_no,
+                    'description': desc,
+                    'customer': customer,
+                    'old_eta': old_eta,
+                    'new_eta': new_eta,
+                    'updated_by': username,
+                    'status': 'ETA Update' # Context column
+                })
+        for advisor, items in items_by_advisor.items():
+            if len(items) == 1:
+                message = f"ETA Changed for {items[0]['item_no']}: {new_eta}"
+            else:
+                message = f"ETA Changed for {len(items)} items: {new_eta}"
+            add_notification_internal(c, message, target_advisor_code=advisor)
         conn.commit()
     except Exception as e:
-        print(f"Error adding notification: {e}")
+        conn.rollback()
+        print(f"Error updating ETA: {e}")
+        return 0, f"Update failed: {e}"
     finally:
         conn.close()
+    invalidate_unread_notifications()
+
+    # Email: one per advisor recipient
+    if items_by_advisor:
+        recipients_by_advisor = get_user_emails_by_advisor_codes(items_by_advisor.keys())
+        try:
+            with mailer.smtp_session() as server:
+                for advisor, items in items_by_advisor.items():
+                    title = f"ETA Update: {items[0]['item_no']}" if len(items) == 1 else f"ETA Update: {len(items)} items"
+                    for email, user in recipients_by_advisor.get(advisor, []):
+                        mailer.send_bulk_notification(email, items, title=title, advisor_name=user, server=server)
+        except Exception as e:
+            print(f"Error sending email: {e}")
+
+    return len(changed), f"ETA updated for {len(changed)} items."
 
 def update_eta(item_id, new_eta, username="Admin"):
     """
@@ -1767,13 +2989,13 @@ def update_eta(item_id, new_eta, username="Admin"):
     
     # Get current details for log and email
     # Also fetch Customer Name for context
-    c.execute("SELECT item_no, item_description, service_advisor, eta, customer_name FROM parts WHERE id = ?", (item_id,))
+    c.execute("SELECT item_no, item_description, service_advisor, eta, customer_name, shipment_ref FROM parts WHERE id = ?", (item_id,))
     row = c.fetchone()
     if not row:
         conn.close()
         return False, "Item not found."
         
-    item_no, desc, advisor, old_eta, customer = row
+    item_no, desc, advisor, old_eta, customer, shipment_ref = row
     
     # Check if changed (String comparison)
     if str(old_eta) == str(new_eta):
@@ -1782,6 +3004,7 @@ def update_eta(item_id, new_eta, username="Admin"):
         
     # Update DB
     c.execute("UPDATE parts SET eta = ?, last_updated = CURRENT_TIMESTAMP WHERE id = ?", (new_eta, item_id))
+    _refresh_shipments(c, [shipment_ref])
     conn.commit()
     conn.close()
     
@@ -0,0 +1,139 @@
+"""
+Streaming exports (xlsx / csv) for the live parts table and the archived (Posted) items.
+
+Rows are read from a SQL cursor EXPORT_CHUNK_ROWS at a time and written straight out:
+xlsx through an openpyxl write-only workbook (each row is serialised as it is appended,
+no cell objects are kept), csv through the csv module. Memory stays bounded by one chunk
+whatever the export size, instead of holding a DataFrame plus a full workbook tree.
+"""
+import csv
+import io
+
+from openpyxl import Workbook
+
+import config
+import db
+import utils
+
+# Result column -> header, in export order
+PARTS_EXPORT_COLUMNS = {
+    "item_no": "Item No", "item_description": "Description", "customer_name": "Customer Name",
+    "vin": "VIN", "document_no": "Document No", "service_advisor": "Service Advisor",
+    "order_no": "Order No", "item_status": "Status", "eta": "ETA", "next_info": "Next Info from PAG",
+    "ordered_qty": "Ordered Qty", "in_transit_qty": "In Transit Qty", "received_qty": "Received Qty",
+    "days_in_stock": "Duration", "cardown": "Car Down", "latest_remark": "Latest Remark"
+}
+ARCHIVE_EXPORT_COLUMNS = {
+    "item_no": "Item No", "item_description": "Description", "customer_name": "Customer Name",
+    "vin": "VIN", "document_no": "Document No", "service_advisor": "Service Advisor",
+    "order_no": "Order No", "item_status": "Status", "eta": "ETA",
+    "ordered_qty": "Ordered Qty", "in_transit_qty": "In Transit Qty", "received_qty": "Received Qty",
+    "cardown": "Car Down", "shipment_ref": "Shipment", "posted_by": "Posted By", "posted_at": "Posted Date"
+}
+
+MIME_TYPES = {
+    'xlsx': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    'csv': "text/csv",
+}
+
+
+# --- Writers ---
+def iter_chunks(cursor, chunk_rows=None):
+    """Yields the cursor's remaining rows in lists of up to chunk_rows."""
+    chunk_rows = chunk_rows or config.EXPORT_CHUNK_ROWS
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            return
+        yield rows
+
+def write_xlsx(out, header, chunks, sheet_name='Sheet1'):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+    ws.append(header)
+    for chunk in chunks:
+        for row in chunk:
+            ws.append(row)
+    wb.save(out)
+
+def write_csv(out, header, chunks):
+    text = io.TextIOWrapper(out, encoding='utf-8-sig', newline='') # BOM so Excel reads UTF-8
+    try:
+        writer = csv.writer(text)
+        writer.writerow(header)
+        for chunk in chunks:
+            writer.writerows(chunk)
+        text.flush()
+    finally:
+        text.detach() # Leave `out` open for the caller
+
+WRITERS = {'xlsx': write_xlsx, 'csv': write_csv}
+
+def export_query(out, fmt, query, params, columns, transform=None):
+    """
+    Streams the rows of a query into `out` (a binary file object) as fmt ('xlsx' / 'csv').
+    columns maps result column -> header. transform(row_dict) may add derived columns
+    in place, or return False to leave the row out.
+    Returns the number of rows written.
+    """
+    conn = db.get_connection()
+    written = 0
+    try:
+        cursor = conn.execute(query, params)
+        names = [d[0] for d in cursor.description]
+
+        def chunks():
+            nonlocal written
+            for chunk in iter_chunks(cursor):
+                rows = []
+                for values in chunk:
+                    rec = dict(zip(names, values))
+                    if transform and transform(rec) is False:
+                        continue
+                    rows.append([rec.get(col) for col in columns])
+                written += len(rows)
+                yield rows
+
+        WRITERS[fmt](out, list(columns.values()), chunks())
+    finally:
+        conn.close()
+    return written
+
+
+# --- Exports ---
+def export_parts(out, fmt, user_type, service_advisor_code=None, is_admin=False):
+    """
+    The live parts table as the given role sees it (same rows and Duration as the dashboard).
+    """
+    query, params = db.build_parts_view_query(user_type, service_advisor_code)
+
+    def transform(rec):
+        # User Filters: Hide 'Invoiced' if not admin
+        if not is_admin and rec['item_status'] == 'Invoiced':
+            return False
+        rec['days_in_stock'] = utils.get_aging_text(
+            rec.get('updates_log'),
+            rec.get('item_status'),
+            rec.get('custom_stock_date'),
+            rec.get('back_order_original_date')
+        )
+        if rec.get('item_no') is not None:
+            rec['item_no'] = str(rec['item_no'])
+
+    return export_query(out, fmt, query, params, PARTS_EXPORT_COLUMNS, transform)
+
+def export_archived(out, fmt):
+    """
+    Every archived (Posted) item, newest first.
+    """
+    return export_query(out, fmt, db.ARCHIVED_PARTS_QUERY, (), ARCHIVE_EXPORT_COLUMNS)
+
+EXPORTS = {'parts': export_parts, 'archived': export_archived}
+
+def export_bytes(kind, fmt, *args):
+    """
+    Runs one of EXPORTS into memory and returns the file's bytes (for st.download_button).
+    """
+    out = io.BytesIO()
+    EXPORTS[kind](out, fmt, *args)
+    return out.getvalue()
@@ -3,6 +3,7 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import os
 import traceback
+from contextlib import contextmanager
 
 import config
 
@@ -27,9 +28,27 @@ ADVISOR_EMAILS = {
 def get_advisor_email(advisor_code):
     return ADVISOR_EMAILS.get(advisor_code, "admin@example.com")
 
-def send_email(receiver_email, subject, body_html):
+@contextmanager
+def smtp_session():
+    """
+    Opens one authenticated SMTP connection for sending several emails.
+    Pass the yielded server to send_email(..., server=server).
+    """
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
+    try:
+        server.starttls() # Secure the connection
+        server.login(SENDER_EMAIL, SENDER_PASSWORD)
+        yield server
+    finally:
+        try:
+            server.quit()
+        except smtplib.SMTPException:
+            pass
+
+def send_email(receiver_email, subject, body_html, server=None):
     """
     Sends an HTML email using SMTP.
+    Uses the given server (see smtp_session) or opens a connection just for this email.
     """
     if not receiver_email:
         print("Skipping email: No receiver specified.")
@@ -45,12 +64,11 @@ def send_email(receiver_email, subject, body_html):
     try:
         # Production SMTP
         # server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) # For 465
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls() # Secure the connection
-        server.login(SENDER_EMAIL, SENDER_PASSWORD)
-        server.sendmail(SENDER_EMAIL, receiver_email, msg.as_string())
-            
-        server.quit()
+        if server is not None:
+            server.sendmail(SENDER_EMAIL, receiver_email, msg.as_string())
+        else:
+            with smtp_session() as session:
+                session.sendmail(SENDER_EMAIL, receiver_email, msg.as_string())
         return True
     except Exception as e:
         print(f"Failed to send email to {receiver_email}: {e}")
@@ -75,9 +93,10 @@ def get_base64_logo():
         print(f"Error loading logo: {e}")
     return None
 
-def send_bulk_notification(advisor_email, items, title="Parts Notification", advisor_name=None, custom_message=None):
+def send_bulk_notification(advisor_email, items, title="Parts Notification", advisor_name=None, custom_message=None, server=None):
     """
     Sends a bulk email to one advisor with a list of items.
+    Pass server (see smtp_session) to reuse one SMTP connection for several emails.
     """
     if not items or not advisor_email:
         return
@@ -257,14 +276,17 @@ def send_bulk_notification(advisor_email, items, title="Parts Notification", adv
     """
     
     print(f"Sending bulk email to {advisor_email} with {len(items)} items...")
-    send_email(advisor_email, title, html_body)
+    return send_email(advisor_email, title, html_body, server=server)
 
-def send_stale_stock_warning(advisor_email, items, advisor_name=None):
+def send_stale_stock_warning(advisor_email, items, advisor_name=None, days_threshold=None, server=None):
     """
     Sends a WARNING email for stale stock items.
+    Returns True if the email was sent.
     """
     if not items or not advisor_email:
-        return
+        return False
+    if days_threshold is None:
+        days_threshold = config.STALE_STOCK_DAYS
         
     first_name = "Advisor"
     if advisor_name:
@@ -340,7 +362,7 @@ def send_stale_stock_warning(advisor_email, items, advisor_name=None):
             <div class="content">
                 <h2>⚠️ Action Required: Stale Stock Warning</h2>
                 <p>Hello {first_name},</p>
-                <p>The following parts have been in stock for <strong>more than 7 days</strong> and have not yet been picked up.</p>
+                <p>The following parts have been in stock for <strong>more than {days_threshold} days</strong> and have not yet been picked up.</p>
                 <p>Please contact the customer immediately to schedule an appointment or arrange pickup.</p>
                 <div style="overflow-x:auto;">
                     {table_html}
@@ -357,4 +379,4 @@ def send_stale_stock_warning(advisor_email, items, advisor_name=None):
     """
     
     print(f"Sending WARNING email to {advisor_email}...")
-    send_email(advisor_email, "⚠️ Reminder: Parts Waiting > 7 Days", html_body)
+    return send_email(advisor_email, f"⚠️ Reminder: Parts Waiting > {days_threshold} Days", html_body, server=server)
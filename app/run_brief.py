@@ -1,14 +1,17 @@
-import db
-from datetime import datetime
 import sys
 
+import db
+import scheduler
+
 def main():
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Executing one-time Morning Brief Job...")
-    try:
-        db.generate_daily_advisor_brief()
-        print("Morning Brief sent successfully.")
-    except Exception as e:
-        print(f"Error sending Morning Brief: {e}")
+    """
+    Runs the Morning Brief once, now (see scheduler.run_manual: recorded in job_runs as
+    a manual run, and refused while a scheduler holds the lock).
+    """
+    scheduler.log("Executing one-time Morning Brief Job...")
+    db.init_db()
+    status = scheduler.run_manual('morning_brief')
+    if status != 'success':
         sys.exit(1)
 
 if __name__ == "__main__":
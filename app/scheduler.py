@@ -1,29 +1,242 @@
-import schedule
+"""
+Background job scheduler.
+
+Run with:  python scheduler.py
+Run one job now (e.g. verify all backups):  python scheduler.py run backup_verify
+  (manual runs take the scheduler lock, so they refuse to start while a scheduler is running)
+
+- Jobs are registered in JOBS, each with its own cadence and timeout.
+- Every run is recorded in the job_runs table (start, end, duration, rows processed, error).
+- Missed runs (e.g. the scheduler was down at 08:00 and restarted at 08:05) are caught up
+  once, as long as the missed slot is still inside the job's catch-up window.
+- Only one scheduler process runs jobs at a time (scheduler_lock table + heartbeat).
+"""
+import os
+import socket
+import sys
+import threading
 import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from datetime import datetime, timedelta
+
+import config
 import db
-from datetime import datetime
-import os
 
-# Ensure DB is initialized or connection works
-# db module handles connection via 'porsche_parts.db'
 
-def job():
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Running Morning Brief Job...")
+def log(message):
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
+
+
+# --- Cadences ---
+class Daily:
+    """Once a day at HH:MM (local time)."""
+    def __init__(self, at):
+        self.hour, self.minute = (int(x) for x in at.split(':'))
+
+    def latest_slot(self, now):
+        slot = now.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+        return slot if slot <= now else slot - timedelta(days=1)
+
+    def __repr__(self):
+        return f"daily at {self.hour:02d}:{self.minute:02d}"
+
+
+class Every:
+    """Every N hours, on boundaries counted from midnight (e.g. hours=6 -> 00:00, 06:00, ...)."""
+    def __init__(self, hours):
+        self.hours = hours
+
+    def latest_slot(self, now):
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        return midnight + timedelta(hours=(now.hour // self.hours) * self.hours)
+
+    def __repr__(self):
+        return f"every {self.hours}h"
+
+
+class Job:
+    def __init__(self, name, func, cadence, timeout_minutes, catchup_hours):
+        self.name = name
+        self.func = func                   # Returns the number of rows/items processed
+        self.cadence = cadence
+        self.timeout = timeout_minutes * 60
+        self.catchup = timedelta(hours=catchup_hours)
+
+
+# --- Jobs ---
+def run_morning_brief():
+    summary = db.generate_daily_advisor_brief()
+    return summary['emails_sent']
+
+def run_stale_stock_warnings():
+    return db.send_stale_stock_warnings()
+
+def run_backup():
+    success, msg = db.create_database_backup("scheduler", skip_unchanged=True)
+    if not success:
+        raise RuntimeError(msg)
+    return 0 if "skipped" in msg else 1
+
+def run_backup_retention():
+    return db.prune_backups()
+
+def run_backup_verify():
+    results = db.verify_backups()
+    failed = [f"{r['name']}: {r['error']}" for r in results if not r['ok']]
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(results)} backups failed verification:\n" + "\n".join(failed))
+    return len(results)
+
+def run_counter_rebuild():
+    mismatches = len(db.check_parts_counters(repair=True))
+    db.rebuild_shipments()
+    return mismatches
+
+def run_notification_prune():
+    return db.prune_notifications()
+
+def run_log_compaction():
+    removed = db.prune_job_runs(config.JOB_RUNS_RETENTION_DAYS)
+    db.checkpoint_wal()
+    return removed
+
+
+JOBS = [
+    Job('morning_brief', run_morning_brief, Daily(config.MORNING_BRIEF_TIME), timeout_minutes=15, catchup_hours=4),
+    Job('stale_stock_warnings', run_stale_stock_warnings, Daily("09:00"), timeout_minutes=15, catchup_hours=8),
+    Job('backup', run_backup, Every(hours=config.BACKUP_INTERVAL_HOURS), timeout_minutes=30, catchup_hours=config.BACKUP_INTERVAL_HOURS),
+    Job('backup_retention', run_backup_retention, Every(hours=6), timeout_minutes=30, catchup_hours=6),
+    Job('backup_verify', run_backup_verify, Daily("04:00"), timeout_minutes=60, catchup_hours=24),
+    Job('counter_rebuild', run_counter_rebuild, Every(hours=6), timeout_minutes=10, catchup_hours=6),
+    Job('notification_prune', run_notification_prune, Daily("03:15"), timeout_minutes=10, catchup_hours=24),
+    Job('log_compaction', run_log_compaction, Daily("03:30"), timeout_minutes=10, catchup_hours=24),
+]
+
+
+# --- Runner ---
+# Jobs run on worker threads so a hung job can be timed out. Python cannot kill a thread,
+# so a timed-out job keeps its worker until it returns; it is not started again meanwhile.
+_executor = ThreadPoolExecutor(max_workers=len(JOBS), thread_name_prefix='scheduler-job')
+_in_flight = {}
+
+def run_job(job, scheduled_for=None, is_manual=False):
+    """
+    Runs one job (blocking up to its timeout) and records it in job_runs.
+    Returns the final status.
+    """
+    previous = _in_flight.get(job.name)
+    if previous is not None and not previous.done():
+        log(f"{job.name}: previous run still in progress, skipping.")
+        return 'running'
+
+    scheduled_for = scheduled_for or datetime.now().replace(microsecond=0)
+    run_id = db.start_job_run(job.name, scheduled_for, is_manual=is_manual)
+    log(f"{job.name}: started (slot {scheduled_for:%Y-%m-%d %H:%M}).")
+
+    future = _executor.submit(job.func)
+    _in_flight[job.name] = future
     try:
-        db.generate_daily_advisor_brief()
-        print("Morning Brief sent successfully.")
+        rows = future.result(timeout=job.timeout)
+        db.finish_job_run(run_id, 'success', rows_processed=rows)
+        log(f"{job.name}: success ({rows} rows).")
+        return 'success'
+    except FutureTimeout:
+        db.finish_job_run(run_id, 'timeout', error=f"Timed out after {job.timeout}s")
+        log(f"{job.name}: timed out after {job.timeout}s.")
+        return 'timeout'
     except Exception as e:
-        print(f"Error sending Morning Brief: {e}")
+        db.finish_job_run(run_id, 'failed', error=traceback.format_exc())
+        log(f"{job.name}: failed: {e}")
+        return 'failed'
 
-# Schedule the job every day at 08:00
-schedule.every().day.at("08:00").do(job)
+def run_due_jobs(now=None):
+    """
+    Runs every job whose latest slot has not been run yet.
+    A missed slot older than the job's catch-up window is recorded as skipped instead.
+    """
+    now = now or datetime.now()
+    for job in JOBS:
+        slot = job.cadence.latest_slot(now)
+        last_slot = db.get_last_job_slot(job.name)
+        if last_slot is not None and last_slot >= slot:
+            continue
+        if now - slot > job.catchup:
+            db.record_skipped_job_run(job.name, slot, f"Missed; outside the {job.catchup} catch-up window")
+            log(f"{job.name}: missed slot {slot:%Y-%m-%d %H:%M} is too old, skipped.")
+            continue
+        run_job(job, scheduled_for=slot)
 
-print("Scheduler started. Waiting for 08:00 trigger...")
-print("Press Ctrl+C to exit.")
+def get_job(name):
+    for job in JOBS:
+        if job.name == name:
+            return job
+    raise KeyError(f"Unknown job: {name}")
 
-# Run immediately for testing? Uncomment to test.
-# job()
+def run_manual(name):
+    """
+    Runs one job now, by hand (scheduler.py run <job>, run_brief.py).
+    Takes the scheduler lock first so it cannot overlap the scheduler's own run of the
+    job; if a scheduler holds the lock, nothing is run and 'locked' is returned.
+    The run is recorded as manual, so the job's next scheduled slot still runs.
+    """
+    job = get_job(name)
+    owner = f"{socket.gethostname()}:{os.getpid()}:manual"
+    if not db.acquire_scheduler_lock(owner, config.SCHEDULER_LOCK_STALE_SECONDS):
+        log(f"{job.name}: the scheduler lock is held by another process; stop the scheduler or let it run the job.")
+        return 'locked'
+
+    has_lock = threading.Event()
+    has_lock.set()
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(owner, has_lock, stop), name='scheduler-heartbeat', daemon=True).start()
+    try:
+        return run_job(job, is_manual=True)
+    finally:
+        stop.set()
+        db.release_scheduler_lock(owner)
+
+def heartbeat(owner, has_lock, stop):
+    """
+    Keeps the scheduler lock alive (or tries to take it) every tick, independently of
+    the job loop, so a long-running job does not let the lock go stale.
+    """
+    while not stop.is_set():
+        try:
+            if db.acquire_scheduler_lock(owner, config.SCHEDULER_LOCK_STALE_SECONDS):
+                if not has_lock.is_set():
+                    interrupted = db.fail_interrupted_job_runs(config.SCHEDULER_LOCK_STALE_SECONDS)
+                    log(f"Acquired scheduler lock ({interrupted} interrupted runs marked failed).")
+                    has_lock.set()
+            elif has_lock.is_set():
+                has_lock.clear()
+                log("Lost scheduler lock to another process; standing by.")
+        except Exception as e:
+            log(f"Heartbeat error: {e}")
+        stop.wait(config.SCHEDULER_TICK_SECONDS)
+
+def main():
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    db.init_db()
+    log("Scheduler started. Jobs: " + ", ".join(f"{j.name} ({j.cadence})" for j in JOBS))
+    log("Press Ctrl+C to exit.")
+
+    has_lock = threading.Event()
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(owner, has_lock, stop), name='scheduler-heartbeat', daemon=True).start()
+    try:
+        while True:
+            if has_lock.is_set():
+                run_due_jobs()
+            time.sleep(config.SCHEDULER_TICK_SECONDS)
+    except KeyboardInterrupt:
+        log("Scheduler stopping.")
+    finally:
+        stop.set()
+        db.release_scheduler_lock(owner)
 
-while True:
-    schedule.run_pending()
-    time.sleep(60) # check every minute
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == 'run':
+        db.init_db()
+        sys.exit(0 if run_manual(sys.argv[2]) == 'success' else 1)
+    main()
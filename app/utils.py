@@ -273,6 +273,9 @@ def parse_invoiced(file_obj, manual_eta):
         print(f"Error parsing Invoiced: {e}")
         return []
 
+# Log format: \n[YYYY-MM-DD HH:MM] User: Action
+LOG_ENTRY_PATTERN = r'\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2})\] (.*?): (.*)'
+
 def parse_log_to_df(log_text):
     """
     Parses the updates_log string into a DataFrame.
@@ -282,15 +285,32 @@ def parse_log_to_df(log_text):
         return pd.DataFrame(columns=['Timestamp', 'User', 'Action'])
     
     # regex pattern
-    pattern = r'\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2})\] (.*?): (.*)'
-    matches = re.findall(pattern, log_text)
-    
+    matches = re.findall(LOG_ENTRY_PATTERN, log_text)
+
     data = []
     for m in matches:
         data.append({'Timestamp': m[0], 'User': m[1], 'Action': m[2]})
-        
+
     return pd.DataFrame(data)
 
+def parse_logs_to_events(logs):
+    """
+    Batch version of parse_log_to_df for many parts in one vectorized pass.
+    logs: Series of updates_log text indexed by part id.
+    Returns a DataFrame with columns: part_id, Timestamp, User, Action.
+    """
+    cols = ['part_id', 'Timestamp', 'User', 'Action']
+    if logs is None or logs.empty:
+        return pd.DataFrame(columns=cols)
+
+    events = logs.fillna('').astype(str).rename_axis('part_id').str.extractall(LOG_ENTRY_PATTERN)
+    if events.empty:
+        return pd.DataFrame(columns=cols)
+
+    events.columns = ['Timestamp', 'User', 'Action']
+    events = events.reset_index(level='match', drop=True).reset_index()
+    return events[cols]
+
 def get_aging_text(log_text, status, custom_stock_date=None, back_order_date=None, received_date=None):
     """
     Returns formatted aging string based on status.
@@ -403,3 +423,81 @@ def get_days_in_stock(log_text):
     return 0
         
 
+
+# Ledger column name -> parts column
+LEDGER_META_COLUMNS = {
+    "Item No": 'item_no',
+    "Description": 'item_description',
+    "Order No": 'order_no',
+    "Status": 'item_status', # Snapshot status (current)
+    "Customer": 'customer_name',
+    "Document No": 'document_no',
+    "VIN": 'vin',
+    "Advisor": 'service_advisor',
+    "ETA": 'eta',
+    "Ordered Qty": 'ordered_qty',
+    "Received Qty": 'received_qty',
+    "In Transit Qty": 'in_transit_qty',
+    "Next Info": 'next_info',
+    "Remarks": 'remarks',
+    "Posted By": 'posted_by',
+    "Posted Date": 'posted_at',
+    "Back Order Date": 'back_order_original_date'
+}
+
+def build_ledger_events(parts_df):
+    """
+    Builds the flat Ledger timeline (one row per log event) for many parts at once.
+    Parses all logs in a single pass and merges the item metadata onto the events.
+    Items without any parsable log entry get a single 'Legacy Record / No Log' row.
+    Returns the events sorted by Timestamp, most recent first.
+    """
+    if parts_df.empty:
+        return pd.DataFrame()
+
+    parts_df = parts_df.reset_index(drop=True)
+
+    # 1. Item Metadata (one row per part)
+    meta = pd.DataFrame({'part_id': parts_df['id']})
+    for label, col in LEDGER_META_COLUMNS.items():
+        meta[label] = parts_df[col] if col in parts_df.columns else None
+
+    # Aging is computed once per item, not once per event
+    meta["Duration"] = parts_df.apply(
+        lambda row: get_aging_text(
+            row.get('updates_log'),
+            row.get('item_status'),
+            row.get('custom_stock_date'),
+            row.get('back_order_original_date'),
+            row.get('received_date')
+        ),
+        axis=1
+    )
+
+    # 2. Events (all logs at once)
+    events = parse_logs_to_events(parts_df.set_index('id')['updates_log'])
+
+    # Fallback for items with no log text (Legacy?)
+    missing = parts_df[~parts_df['id'].isin(events['part_id'])]
+    if not missing.empty:
+        legacy = pd.DataFrame({
+            'part_id': missing['id'],
+            'Timestamp': missing['last_updated'].astype(str),
+            'User': "System",
+            'Action': "Legacy Record / No Log"
+        })
+        events = pd.concat([events, legacy], ignore_index=True)
+
+    ledger_df = events.merge(meta, on='part_id', how='left').drop(columns=['part_id'])
+    return sort_ledger_events(ledger_df)
+
+def sort_ledger_events(ledger_df):
+    """
+    Sorts Ledger events by Timestamp, most recent first (unparsable timestamps last).
+    """
+    if ledger_df.empty:
+        return ledger_df
+    ledger_df = ledger_df.copy()
+    ledger_df['Timestamp_dt'] = pd.to_datetime(ledger_df['Timestamp'], format='%Y-%m-%d %H:%M', errors='coerce')
+    ledger_df = ledger_df.sort_values(by='Timestamp_dt', ascending=False, kind='stable').drop(columns=['Timestamp_dt'])
+    return ledger_df.reset_index(drop=True)